@@ -80,12 +80,11 @@ class Filter():
         # Get waveform, and time array
         wf = self.input_waveform()
         timearray = self.input_time()
-        npoints1 = self.input_waveform_obj.npoints
+        npoints1 = self.input_waveform_obj.npoints_ext
 
         # Reset generator phase and time multiplier
         self.input_waveform_obj.phase += phase
         self.input_waveform_obj.timemult = 1.0
-        self.input_waveform_obj.npoints = int(self.input_waveform_obj.npoints/timemult)
         self.input_waveform_obj.refresh_params()
 
         # Filter waveform
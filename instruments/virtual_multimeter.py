@@ -4,7 +4,7 @@
 # Default resistance unit: Ohms
 # By pfjarschel, 2023
 
-import os
+import os, weakref, threading
 import numpy as np
 from instruments.virtual_socketinstrument import VirtualSocketInstrument
 from PyQt6 import uic
@@ -17,6 +17,28 @@ thisfile = os.path.basename(__file__)
 # Load ui file
 FormUI, WindowUI = uic.loadUiType(f"{main_path}/virtual_multimeter.ui")
 
+# Measurement modes
+MODE_V = 0
+MODE_A = 1
+MODE_R = 2
+
+# Reduce the input data to a single noisy reading, one function per measurement mode
+# data.sum()/size skips the extra Python-level work np.mean does on every call
+def _volt(data, imp, noise, rnd):
+    return data.sum()/data.shape[0] + (rnd - 0.5)*noise
+
+def _curr(data, imp, noise, rnd):
+    return data.sum()/data.shape[0]/imp + (rnd - 0.5)*noise
+
+def _res(data, imp, noise, rnd):
+    return imp + (rnd - 0.5)*noise
+
+# Transform for each measurement mode
+_transforms = (_volt, _curr, _res)
+
+# Reading formatter, %-formatting skips the format-spec parsing of f-strings
+_fmt3 = "%.3f".__mod__
+
 # Communications class
 class VirtualMultimeterComms(VirtualSocketInstrument):
     def __init__(self, dev, verbose=False):
@@ -26,41 +48,38 @@ class VirtualMultimeterComms(VirtualSocketInstrument):
         # Commands dictionaries
         self.comms_meas = {}
 
+        # Pre-bound measurement function
+        self._input_channel = dev.input_channel
+
         # Instrument functions
-        self.comms_meas["volt?"] = self.get_volt
-        self.comms_meas["curr?"] = self.get_curr
-        self.comms_meas["ohms?"] = self.get_ohms
+        self.comms_meas["volt?"] = lambda args: self.get_meas(MODE_V)
+        self.comms_meas["curr?"] = lambda args: self.get_meas(MODE_A)
+        self.comms_meas["ohms?"] = lambda args: self.get_meas(MODE_R)
         self.comms_dicts["meas"] = self.comms_meas
 
+        # Block measurements (meas:volt:block? N), N readings in a single reply
+        self.comms_meas_volt = {}
+        self.comms_meas_volt["block?"] = lambda args: self.get_meas_block(MODE_V, args)
+        self.comms_meas["volt"] = self.comms_meas_volt
+        self.max_block = 100000  # Readings per block reply, keeps the reply size bounded
+
     def GET_IDN(self, args):
         return "PFJ Systems Inc., Virtual Multimeter VM1, S/N T347596"
     
-    def get_volt(self, args):
-        self.dev.voltRadio.setChecked(True)
-        self.dev.measV = True
-        self.dev.measA = False
-        self.dev.measR = False
-
-        val = self.dev.input_channel()
-        return f"{val:.3f}"
-    
-    def get_curr(self, args):
-        self.dev.currRadio.setChecked(True)
-        self.dev.measV = False
-        self.dev.measA = True
-        self.dev.measR = False
-
-        val = self.dev.input_channel()
-        return f"{val:.3f}"
-    
-    def get_ohms(self, args):
-        self.dev.ohmsRadio.setChecked(True)
-        self.dev.measV = False
-        self.dev.measA = False
-        self.dev.measR = True
-
-        val = self.dev.input_channel()
-        return f"{val:.3f}"
+    def get_meas(self, mode):
+        self.dev._set_mode_fast(mode)
+        return _fmt3(self._input_channel())
+
+    def get_meas_block(self, mode, args):
+        n = 1
+        try:
+            if args:
+                n = min(max(int(args[0]), 1), self.max_block)
+        except ValueError:
+            pass
+        self.dev._set_mode_fast(mode)
+        read = self._input_channel
+        return ",".join([_fmt3(read()) for i in range(n)])
 
 # Main instrument class
 class VirtualMultimeter(FormUI, WindowUI):
@@ -71,18 +90,18 @@ class VirtualMultimeter(FormUI, WindowUI):
     sampletime = 0.1
     int_time = 0.25
     npoints = 10
+    noise_block = 4096
 
     v_noise = 0.001
     a_noise = 0.001
     r_noise = 0.5
 
-    measV = True
-    measA = False
-    measR = False
+    _mode = MODE_V
+    _transform = staticmethod(_volt)
 
-    # Measurement stuff
-    meas_timer = QTimer()
-    meas_timer.setInterval(int(int_time*1000))
+    # Measurement stuff: a single timer refreshes all the visible multimeters
+    meas_timer = None
+    _instances = weakref.WeakSet()
 
     # Default functions
     def __init__(self, verbose=False):
@@ -93,7 +112,20 @@ class VirtualMultimeter(FormUI, WindowUI):
         self.setupUi(self)
         self.setupOtherUi()
         self.setupActions()
-        self.meas_timer.start()
+        self._zero_buf = np.zeros(self.npoints)
+        self._last_str = ""
+        self._rng = np.random.default_rng()
+        self._noise_buf = self._rng.random(self.noise_block)
+        self._noise_idx = 0
+        self._noise_lock = threading.Lock()
+        self.set_inputs()
+        self._visible = False
+        VirtualMultimeter._instances.add(self)
+        if VirtualMultimeter.meas_timer is None:
+            VirtualMultimeter.meas_timer = QTimer()
+            VirtualMultimeter.meas_timer.setInterval(int(self.int_time*1000))
+            VirtualMultimeter.meas_timer.timeout.connect(VirtualMultimeter.measAll)
+            VirtualMultimeter.meas_timer.start()
         self.comms = VirtualMultimeterComms(self, verbose)
 
         self.show()
@@ -102,13 +134,26 @@ class VirtualMultimeter(FormUI, WindowUI):
         print("Deleting multimeter object")
 
     def closeEvent(self, event):
+        VirtualMultimeter._instances.discard(self)
         self.comms.close([])
         event.accept()
+
+    # The display is only refreshed while the window is visible (this includes minimizing)
+    # SCPI queries call input_channel directly, so they are not affected
+    def showEvent(self, event):
+        self._visible = True
+        self.measLoop()
+        event.accept()
+
+    def hideEvent(self, event):
+        self._visible = False
+        event.accept()
     
     # UI functions
     def setupOtherUi(self):
         self.lcdNumber.setSmallDecimalPoint(True)
         self.lcdNumber.setDigitCount(6)
+        self.mode_radios = (self.voltRadio, self.currRadio, self.ohmsRadio)
     
     def setupActions(self):
         # Connect UI signals to functions
@@ -116,18 +161,36 @@ class VirtualMultimeter(FormUI, WindowUI):
         self.currRadio.clicked.connect(self.setMeasurement)
         self.ohmsRadio.clicked.connect(self.setMeasurement)
 
-        self.meas_timer.timeout.connect(self.measLoop)
-
     def setMeasurement(self):
-        self.measV = self.voltRadio.isChecked()
-        self.measA = self.currRadio.isChecked()
-        self.measR = self.ohmsRadio.isChecked()
+        if self.voltRadio.isChecked():
+            self._set_mode_fast(MODE_V)
+        elif self.currRadio.isChecked():
+            self._set_mode_fast(MODE_A)
+        elif self.ohmsRadio.isChecked():
+            self._set_mode_fast(MODE_R)
+
+    # Only changes the internal state, so it is safe to call from the comms threads
+    # The radio buttons are synced in measLoop, on the GUI thread
+    def _set_mode_fast(self, mode):
+        self._mode = mode
+        self._transform = _transforms[mode]
 
     # Measurement functions   
+    @classmethod
+    def measAll(cls):
+        for meter in list(cls._instances):
+            if meter._visible:
+                meter.measLoop()
+
     def measLoop(self):
-        val = self.input_channel()
-        val_str = f"{val:.3f}"
-        self.lcdNumber.display(val_str)
+        radio = self.mode_radios[self._mode]
+        if not radio.isChecked():
+            radio.setChecked(True)
+
+        val_str = _fmt3(self.input_channel())
+        if val_str != self._last_str:
+            self.lcdNumber.display(val_str)
+            self._last_str = val_str
 
     # I/O functions
     # Start communication server
@@ -138,22 +201,41 @@ class VirtualMultimeter(FormUI, WindowUI):
     def set_inputs(self, main=None):    
         self.input_obj = main
 
+        # Pre-bind the input getters used on every reading
+        if main:
+            self._out_signal = main.output_signal
+            self._imp_getter = lambda: main.impedance
+        else:
+            self._out_signal = self._zero_signal
+            self._imp_getter = lambda: 1e9
+
     # Input functions: all parameters and instrument inputs are processed here. These are active (calls the output from other instruments)
     def input_channel(self):
-        if self.input_obj:
-            imp = self.input_obj.impedance
-            data = self.input_obj.output_signal()
-        else:
-            imp = 1e9
-            data = np.zeros([self.npoints])
-        if self.measV:
-            val = np.mean(data) + np.random.random()*self.v_noise - self.v_noise/2.0
-        elif self.measA:
-            val = np.mean(data)/imp + np.random.random()*self.a_noise - self.a_noise/2.0
-        elif self.measR:
-            val = imp + np.random.random()*self.r_noise - self.r_noise/2.0
-
-        return val
+        # Resistance only needs the impedance, so don't ask the source for a signal
+        if self._mode == MODE_R:
+            return _res(None, self._imp_getter(), self.r_noise, self.next_random())
+
+        data = self._out_signal()
+        imp = self._imp_getter()
+        noise = (self.v_noise, self.a_noise, self.r_noise)[self._mode]
+        return self._transform(data, imp, noise, self.next_random())
+
+    # Input signal when nothing is connected
+    def _zero_signal(self):
+        if self._zero_buf.shape[0] != self.npoints:
+            self._zero_buf = np.zeros(self.npoints)
+        return self._zero_buf
+
+    # Uniform random numbers, generated in blocks and consumed one at a time
+    # Called from both the GUI timer and the SCPI threads, so the index and the refill are guarded by a lock
+    def next_random(self):
+        with self._noise_lock:
+            idx = self._noise_idx
+            if idx >= self.noise_block:
+                self._noise_buf = self._rng.random(self.noise_block)
+                idx = 0
+            self._noise_idx = idx + 1
+            return self._noise_buf[idx]
 
     # Output functions: all instrument outputs are processed here. These are passive (called from other instruments)
     # Output sample time 
@@ -5,15 +5,14 @@
 # By pfjarschel, 2021
 
 # Imports
-import os, time
+import os, time, math, bisect
 import numpy as np
-from scipy.interpolate import interp1d
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from matplotlib.ticker import (MultipleLocator, AutoMinorLocator)
 from PyQt6 import uic, QtCore
-from PyQt6.QtCore import QTimer, QDir
+from PyQt6.QtCore import QTimer, QDir, QThread
 from PyQt6.QtWidgets import QFileDialog
 from instruments.virtual_socketinstrument import VirtualSocketInstrument
 
@@ -24,12 +23,76 @@ thisfile = os.path.basename(__file__)
 # Load ui file
 FormUI, WindowUI = uic.loadUiType(f"{main_path}/virtual_oscilloscope.ui")
 
+# SI prefixes, by power of 1000
+SI_UNITS = {  0:' ',
+   1:'K',  2:'M',  3:'G',  4:'T',  5:'P',  6:'E',  7:'Z',  8:'Y',  9:'R',  10:'Q',
+  -1:'m', -2:'u', -3:'n', -4:'p', -5:'f', -6:'a', -7:'z', -8:'y', -9:'r', -10:'q'
+}
+
+# Mantissa breakpoints between the 1-2-5 steps of the scale dials
+SCALE_STEPS = [3.5, 7.5]
+
+# Convert a scale value to a 1-2-5 dial position, decade_offset being the decade of dial position 0
+# The mantissa bucket gives both the step ((bucket + 1) % 3) and the decade carry (bucket//2)
+def scale2dial(val, decade_offset):
+    valog = math.log10(val)
+    val_sci = math.ceil(valog) - 1
+    val_num = 10**(valog - math.ceil(valog) + 1)
+    bucket = bisect.bisect_right(SCALE_STEPS, val_num)
+    return (val_sci + bucket//2 + decade_offset)*3 + (bucket + 1) % 3
+
+# Serialize an array as an IEEE 488.2 definite length block of little endian float32 values
+def array2block(array):
+    payload = np.ascontiguousarray(array, dtype="<f4").tobytes()
+    length = str(len(payload))
+    return f"#{len(length)}{length}".encode("Latin1") + payload
+
+# Serialize an array as comma separated values, in a single join
+# Single precision data is printed with the digits it actually holds
+def array2csv(array):
+    array = np.asarray(array)
+    if array.dtype == np.float32:
+        return ",".join(np.char.mod("%.7g", array))
+    return ",".join(map(str, array.tolist()))
+
+# Write a new acquisition into a row of a ring buffer, and average using a running sum of the rows
+# n_summed is the number of rows already in the sum, once the buffer is full the overwritten row is evicted
+def update_and_average(buf, avg_sum, new_data, write_idx, n_summed):
+    if n_summed == buf.shape[0]:
+        avg_sum -= buf[write_idx]
+    else:
+        n_summed += 1
+    buf[write_idx] = new_data
+    avg_sum += buf[write_idx]
+    return avg_sum/n_summed
+
+# Write a new acquisition into a row of a ring buffer, and chain the valid rows into out, newest first
+def update_and_hold(buf, new_data, write_idx, n_valid, out):
+    buf[write_idx] = new_data
+    order = (write_idx - np.arange(n_valid)) % buf.shape[0]
+    np.take(buf, order, axis=0, out=out.reshape(n_valid, -1))
+
+# Writes a data table to a text file in a background thread, so large captures do not block the UI
+class DataSaver(QThread):
+    def __init__(self, filename, table, header, fmt):
+        super().__init__()
+        self.filename = filename
+        self.table = table
+        self.header = header
+        self.fmt = fmt
+
+    def run(self):
+        with open(self.filename, "w", buffering=1 << 20) as file:
+            np.savetxt(file, self.table, fmt=self.fmt, delimiter="\t", header=self.header, comments="")
+
 # Communications class
 class VirtualOscilloscopeComms(VirtualSocketInstrument):
     def __init__(self, dev, verbose=False):
         super().__init__(verbose)
         self.dev = dev
         self.c_chan = 1
+        self.binary = False
+        self.settle_timeout = 5.0
 
         # Commands dictionaries
         self.comms_horiz = {}
@@ -46,6 +109,7 @@ class VirtualOscilloscopeComms(VirtualSocketInstrument):
         self.comms_root["run?"] = self.get_run
         self.comms_root["run"] = self.run
         self.comms_root["stop"] = self.stop
+        self.comms_root["settle?"] = self.get_settle
         
         # Horizontal Commands
         self.comms_horiz["scale?"] = self.get_hscale
@@ -70,52 +134,17 @@ class VirtualOscilloscopeComms(VirtualSocketInstrument):
         self.comms_acq["hold"] = self.set_hold
         self.comms_acq["holdn?"] = self.get_holdn
         self.comms_acq["holdn"] = self.set_holdn
+        self.comms_acq["format?"] = self.get_format
+        self.comms_acq["format"] = self.set_format
         self.comms_dicts["acq"] = self.comms_acq
 
         # Channel Commands
-        self.comms_c1["enable?"] = self.get_c1_enable
-        self.comms_c1["enable"] = self.set_c1_enable
-        self.comms_c1["asx?"] = self.get_c1_asx
-        self.comms_c1["asx"] = self.set_c1_asx
-        self.comms_c1["scale?"] = self.get_c1_scale
-        self.comms_c1["scale"] = self.set_c1_scale
-        self.comms_c1["offset?"] = self.get_c1_offset
-        self.comms_c1["offset"] = self.set_c1_offset
-        self.comms_c1["data?"] = self.get_c1_data
-        self.comms_dicts["c1"] = self.comms_c1
-        
-        self.comms_c2["enable?"] = self.get_c2_enable
-        self.comms_c2["enable"] = self.set_c2_enable
-        self.comms_c2["asx?"] = self.get_c2_asx
-        self.comms_c2["asx"] = self.set_c2_asx
-        self.comms_c2["scale?"] = self.get_c2_scale
-        self.comms_c2["scale"] = self.set_c2_scale
-        self.comms_c2["offset?"] = self.get_c2_offset
-        self.comms_c2["offset"] = self.set_c2_offset
-        self.comms_c2["data?"] = self.get_c2_data
-        self.comms_dicts["c2"] = self.comms_c2
-        
-        self.comms_c3["enable?"] = self.get_c3_enable
-        self.comms_c3["enable"] = self.set_c3_enable
-        self.comms_c3["asx?"] = self.get_c3_asx
-        self.comms_c3["asx"] = self.set_c3_asx
-        self.comms_c3["scale?"] = self.get_c3_scale
-        self.comms_c3["scale"] = self.set_c3_scale
-        self.comms_c3["offset?"] = self.get_c3_offset
-        self.comms_c3["offset"] = self.set_c3_offset
-        self.comms_c3["data?"] = self.get_c3_data
-        self.comms_dicts["c3"] = self.comms_c3
-        
-        self.comms_c4["enable?"] = self.get_c4_enable
-        self.comms_c4["enable"] = self.set_c4_enable
-        self.comms_c4["asx?"] = self.get_c4_asx
-        self.comms_c4["asx"] = self.set_c4_asx
-        self.comms_c4["scale?"] = self.get_c4_scale
-        self.comms_c4["scale"] = self.set_c4_scale
-        self.comms_c4["offset?"] = self.get_c4_offset
-        self.comms_c4["offset"] = self.set_c4_offset
-        self.comms_c4["data?"] = self.get_c4_data
-        self.comms_dicts["c4"] = self.comms_c4
+        for ch, comms_c in enumerate([self.comms_c1, self.comms_c2, self.comms_c3, self.comms_c4], 1):
+            for op in ["enable", "asx", "scale", "offset"]:
+                comms_c[f"{op}?"] = self.channel_command(ch, getattr(self, f"get_channel_{op}"))
+                comms_c[op] = self.channel_command(ch, getattr(self, f"set_channel_{op}"))
+            comms_c["data?"] = self.channel_command(ch, self.get_channel_data)
+            self.comms_dicts[f"c{ch}"] = comms_c
         
     def GET_IDN(self, args):
         return "PFJ Systems Inc., Virtual Oscilloscope VOSC1, S/N P92348"
@@ -129,26 +158,22 @@ class VirtualOscilloscopeComms(VirtualSocketInstrument):
     def stop(self, args):
         self.dev.stopAcquisition()
     
+    # Wait until a whole frame has been acquired after this command, so the data reflects the current settings
+    def get_settle(self, args):
+        target = self.dev.frame_count + 2
+        deadline = time.time() + self.settle_timeout
+        while self.dev.running and self.dev.frame_count < target and time.time() < deadline:
+            time.sleep(0.001)
+        return "1"
+
     def get_hscale(self, args):
         return f"{self.dev.timediv}"
     
     def set_hscale(self, args):
         try:
             if args:
-                val = np.abs(float(args[0]))
-                valog = np.log10(val)
-                val_sci = np.ceil(valog) - 1
-                val_num = 10**(valog - np.ceil(valog) + 1)
-                hvalue = 0
-                if val_num >= 0.5 and val_num < 3.5:
-                    hvalue = 1
-                if val_num >= 3.5 and val_num < 7.5:
-                    hvalue = 2
-                if val_num >= 7.5:
-                    hvalue = 0
-                    val_sci += 1
-                
-                dialval = (val_sci + 12)*3 + hvalue
+                val = abs(float(args[0]))
+                dialval = scale2dial(val, 12)
                 if dialval < 0:
                     dialval = 0
                 if dialval > 39:
@@ -173,10 +198,9 @@ class VirtualOscilloscopeComms(VirtualSocketInstrument):
             pass
                 
     def get_hdata(self, args):
-        ret_string = ""
-        for val in self.dev.x_axis:
-            ret_string = f"{ret_string}{val},"
-        return ret_string[:-1]
+        if self.binary:
+            return array2block(self.dev.x_axis)
+        return array2csv(self.dev.x_axis)
     
     def trigger_mode(self, args):
         if self.dev.triggerfreeRadio.isChecked():
@@ -251,66 +275,64 @@ class VirtualOscilloscopeComms(VirtualSocketInstrument):
         except:
             pass
         
+    def get_format(self, args):
+        return "binary" if self.binary else "ascii"
+    
+    def set_format(self, args):
+        if args:
+            if args[0] in ("bin", "binary"):
+                self.binary = True
+            if args[0] in ("asc", "ascii"):
+                self.binary = False
+        
     def get_channel_enable(self, args):
-        returnval = eval(f"int(self.dev.ch{self.c_chan}Check.isChecked())")
+        returnval = int(self.dev.channelsChecks[self.c_chan - 1].isChecked())
         return f"{returnval}"
     
     def set_channel_enable(self, args):
         try:
             if args:
                 if (args[0] == "1") or (args[0] == "true") or (args[0] == "on"):
-                    eval(f"self.dev.ch{self.c_chan}Check.setChecked(True)")
+                    self.dev.channelsChecks[self.c_chan - 1].setChecked(True)
                 else:
-                    eval(f"self.dev.ch{self.c_chan}Check.setChecked(False)")
+                    self.dev.channelsChecks[self.c_chan - 1].setChecked(False)
         except:
             pass
     
     def get_channel_asx(self, args):
-        returnval = eval(f"int(self.dev.ch{self.c_chan}XCheck.isChecked())")
+        returnval = int(self.dev.xyChecks[self.c_chan - 1].isChecked())
         return f"{returnval}"
     
     def set_channel_asx(self, args):
         try:
             if args:
                 if (args[0] == "1") or (args[0] == "true") or (args[0] == "on"):
-                    eval(f"self.dev.ch{self.c_chan}XCheck.setChecked(True)")
+                    self.dev.xyChecks[self.c_chan - 1].setChecked(True)
                 else:
-                    eval(f"self.dev.ch{self.c_chan}XCheck.setChecked(False)")
+                    self.dev.xyChecks[self.c_chan - 1].setChecked(False)
                 self.dev.change_xy()
         except:
             pass
     
     def get_channel_scale(self, args):
-        returnval = eval(f"float(self.dev.voltdivs[{self.c_chan - 1}])")
+        returnval = float(self.dev.voltdivs[self.c_chan - 1])
         return returnval
     
     def set_channel_scale(self, args):
         try:
             if args:
                 val = float(args[0])
-                valog = np.log10(val)
-                val_sci = np.ceil(valog) - 1
-                val_num = 10**(valog - np.ceil(valog) + 1)
-                vvalue = 0
-                if val_num >= 0.5 and val_num < 3.5:
-                    vvalue = 1
-                if val_num >= 3.5 and val_num < 7.5:
-                    vvalue = 2
-                if val_num >= 7.5:
-                    vvalue = 0
-                    val_sci += 1
-                
-                dialval = (val_sci + 4)*3 + vvalue
+                dialval = scale2dial(val, 4)
                 if dialval < 0:
                     dialval = 0
                 if dialval > 15:
                     dialval = 15
-                eval(f"self.dev.ch{self.c_chan}scaleDial.setValue(int(dialval))")
+                self.dev.scaleDials[self.c_chan - 1].setValue(int(dialval))
         except:
             pass
     
     def get_channel_offset(self, args):
-        returnval = eval(f"float(self.dev.ch{self.c_chan}offsSpin.value())")
+        returnval = float(self.dev.offsSpins[self.c_chan - 1].value())
         return f"{returnval}"
     
     def set_channel_offset(self, args):
@@ -321,128 +343,22 @@ class VirtualOscilloscopeComms(VirtualSocketInstrument):
                     val = 100.0
                 if val > 100.0:
                     val = 100.0
-                eval(f"self.dev.ch{self.c_chan}offsSpin.setValue({val})")
+                self.dev.offsSpins[self.c_chan - 1].setValue(val)
         except:
             pass
     
     def get_channel_data(self, args):
-        array = eval(f"self.dev.y_axis[{self.c_chan - 1}]")
-        ret_string = ""
-        for val in array:
-            ret_string = f"{ret_string}{val},"
-        return ret_string[:-1]
+        array = self.dev.y_axis[self.c_chan - 1]
+        if self.binary:
+            return array2block(array)
+        return array2csv(array)
     
-    def get_c1_enable(self, args):
-        self.c_chan = 1
-        return self.get_channel_enable(args)
-    def set_c1_enable(self, args):
-        self.c_chan = 1
-        self.set_channel_enable(args)
-    def get_c1_asx(self, args):
-        self.c_chan = 1
-        return self.get_channel_asx(args)
-    def set_c1_asx(self, args):
-        self.c_chan = 1
-        self.set_channel_asx(args)
-    def get_c1_scale(self, args):
-        self.c_chan = 1
-        return self.get_channel_scale(args)
-    def set_c1_scale(self, args):
-        self.c_chan = 1
-        self.set_channel_scale(args)
-    def get_c1_offset(self, args):
-        self.c_chan = 1
-        return self.get_channel_offset(args)
-    def set_c1_offset(self, args):
-        self.c_chan = 1
-        self.set_channel_offset(args)
-    def get_c1_data(self, args):
-        self.c_chan = 1
-        return self.get_channel_data(args)
-        
-    def get_c2_enable(self, args):
-        self.c_chan = 2
-        return self.get_channel_enable(args)
-    def set_c2_enable(self, args):
-        self.c_chan = 2
-        self.set_channel_enable(args)
-    def get_c2_asx(self, args):
-        self.c_chan = 2
-        return self.get_channel_asx(args)
-    def set_c2_asx(self, args):
-        self.c_chan = 2
-        self.set_channel_asx(args)
-    def get_c2_scale(self, args):
-        self.c_chan = 2
-        return self.get_channel_scale(args)
-    def set_c2_scale(self, args):
-        self.c_chan = 2
-        self.set_channel_scale(args)
-    def get_c2_offset(self, args):
-        self.c_chan = 2
-        return self.get_channel_offset(args)
-    def set_c2_offset(self, args):
-        self.c_chan = 2
-        self.set_channel_offset(args)
-    def get_c2_data(self, args):
-        self.c_chan = 2
-        return self.get_channel_data(args)
-        
-    def get_c3_enable(self, args):
-        self.c_chan = 3
-        return self.get_channel_enable(args)
-    def set_c3_enable(self, args):
-        self.c_chan = 3
-        self.set_channel_enable(args)
-    def get_c3_asx(self, args):
-        self.c_chan = 3
-        return self.get_channel_asx(args)
-    def set_c3_asx(self, args):
-        self.c_chan = 3
-        self.set_channel_asx(args)
-    def get_c3_scale(self, args):
-        self.c_chan = 3
-        return self.get_channel_scale(args)
-    def set_c3_scale(self, args):
-        self.c_chan = 3
-        self.set_channel_scale(args)
-    def get_c3_offset(self, args):
-        self.c_chan = 3
-        return self.get_channel_offset(args)
-    def set_c3_offset(self, args):
-        self.c_chan = 3
-        self.set_channel_offset(args)
-    def get_c3_data(self, args):
-        self.c_chan = 3
-        return self.get_channel_data(args)
-        
-    def get_c4_enable(self, args):
-        self.c_chan = 4
-        return self.get_channel_enable(args)
-    def set_c4_enable(self, args):
-        self.c_chan = 4
-        self.set_channel_enable(args)
-    def get_c4_asx(self, args):
-        self.c_chan = 4
-        return self.get_channel_asx(args)
-    def set_c4_asx(self, args):
-        self.c_chan = 4
-        self.set_channel_asx(args)
-    def get_c4_scale(self, args):
-        self.c_chan = 4
-        return self.get_channel_scale(args)
-    def set_c4_scale(self, args):
-        self.c_chan = 4
-        self.set_channel_scale(args)
-    def get_c4_offset(self, args):
-        self.c_chan = 4
-        return self.get_channel_offset(args)
-    def set_c4_offset(self, args):
-        self.c_chan = 4
-        self.set_channel_offset(args)
-    def get_c4_data(self, args):
-        self.c_chan = 4
-        return self.get_channel_data(args)
+    # Bind a channel function to a fixed channel
+    def channel_command(self, ch, func):
+        def command(args):
+            self.c_chan = ch
+            return func(args)
+        return command
 
 
 # Main instrument class
@@ -465,19 +381,36 @@ class VirtualOscilloscope(FormUI, WindowUI):
     input_objs = [None, None, None, None]  
 
     # Internal parameters
-    busy = False
+    looping = False
+    scales_pending = False
+    sync_pending = False
+    loop_interval = 10
     running = False
     loop_timer = None
     mastervscale = [-5.0, 5.0]
     sampletime = timediv*10
     x_axis = np.linspace(timeoffs, timeoffs + sampletime, npoints)
-    y_axis = np.zeros([4, npoints])
-    avg_buffer = np.zeros([4, 2, npoints])
-    hold_buffer = np.zeros([4, 2, npoints])
-    avg_counter = 0
+    show_data = np.zeros([4, 0], dtype=np.float32)
+    y_axis = np.zeros([4, npoints], dtype=np.float32)
+    avg_buffer = np.zeros([4, 2, npoints], dtype=np.float32)
+    avg_sum = np.zeros([4, npoints])
+    avg_storage = np.zeros([4, 0, npoints], dtype=np.float32)
+    hold_storage = np.zeros([4, 0, npoints], dtype=np.float32)
+    hold_buffer = np.zeros([4, 2, npoints], dtype=np.float32)
+    avg_counts = [0, 0, 0, 0]
     hold_counter = 0
+    avg_write_idx = [0, 0, 0, 0]
+    hold_write_idx = 0
+    hold_x_axis = np.zeros(0)
+    hold_x_base = None
     xymode = False
     xy_x = 1    
+    rs_npoints = 0
+    axes_dirty = True
+    frame_count = 0
+    saver = None
+    marker_max_points = 500
+    axes_xy = False
     
     # Default functions
     def __init__(self, verbose = False):
@@ -496,7 +429,10 @@ class VirtualOscilloscope(FormUI, WindowUI):
         print("Deleting oscilloscope object")
         
     def closeEvent(self, event):
+        self.looping = False
         self.loop_timer.stop()
+        if self.saver is not None:
+            self.saver.wait()
         self.comms.close([])
         event.accept()
         
@@ -506,6 +442,13 @@ class VirtualOscilloscope(FormUI, WindowUI):
         self.setup_graph()
         self.channelsChecks = [self.ch1Check, self.ch2Check, self.ch3Check, self.ch4Check]
         self.xyChecks = [self.ch1XCheck, self.ch2XCheck, self.ch3XCheck, self.ch4XCheck]
+        self.scaleDials = [self.ch1scaleDial, self.ch2scaleDial, self.ch3scaleDial, self.ch4scaleDial]
+        self.offsSpins = [self.ch1offsSpin, self.ch2offsSpin, self.ch3offsSpin, self.ch4offsSpin]
+        self.offsDials = [self.ch1offsDial, self.ch2offsDial, self.ch3offsDial, self.ch4offsDial]
+        self.scaleInds = [self.ch1scaleInd, self.ch2scaleInd, self.ch3scaleInd, self.ch4scaleInd]
+        self.channels_enabled = [check.isChecked() for check in self.channelsChecks]
+        self.lines_visible = [False, False, False, False]
+        self.setAxes()
 
     def setupActions(self):
         # Connect UI signals to functions
@@ -513,34 +456,26 @@ class VirtualOscilloscope(FormUI, WindowUI):
         self.stopBut.clicked.connect(self.stopAcquisition)
         self.saveBut.clicked.connect(self.saveData)
         self.holdCheck.clicked.connect(self.setAcquisition)
-        self.ch1XCheck.clicked.connect(self.change_xy)
-        self.ch2XCheck.clicked.connect(self.change_xy)
-        self.ch3XCheck.clicked.connect(self.change_xy)
-        self.ch4XCheck.clicked.connect(self.change_xy)
-        self.hoffsetSpin.valueChanged.connect(self.setScales)
+        for check in self.xyChecks:
+            check.clicked.connect(self.change_xy)
+        for check in self.channelsChecks:
+            check.stateChanged.connect(self.updateChannels)
         self.pointsSpin.valueChanged.connect(self.setAcquisition)
         self.avgSpin.valueChanged.connect(self.setAcquisition)
         self.holdSpin.valueChanged.connect(self.setAcquisition)
-        self.ch1offsSpin.valueChanged.connect(self.setScales)
-        self.ch2offsSpin.valueChanged.connect(self.setScales)
-        self.ch3offsSpin.valueChanged.connect(self.setScales)
-        self.ch4offsSpin.valueChanged.connect(self.setScales)
-        self.hscaleDial.valueChanged.connect(self.syncDialsSpins)
-        self.hoffsetDial.valueChanged.connect(self.syncDialsSpins)
-        self.ch1scaleDial.valueChanged.connect(self.syncDialsSpins)
-        self.ch2scaleDial.valueChanged.connect(self.syncDialsSpins)
-        self.ch3scaleDial.valueChanged.connect(self.syncDialsSpins)
-        self.ch4scaleDial.valueChanged.connect(self.syncDialsSpins)
-        self.ch1offsDial.valueChanged.connect(self.syncDialsSpins)
-        self.ch2offsDial.valueChanged.connect(self.syncDialsSpins)
-        self.ch3offsDial.valueChanged.connect(self.syncDialsSpins)
-        self.ch4offsDial.valueChanged.connect(self.syncDialsSpins)
+
+        # Scale changes are coalesced, so dragging a dial recomputes the scales once per event loop turn
+        for spin in [self.hoffsetSpin] + self.offsSpins:
+            spin.valueChanged.connect(self.requestScales)
+        for dial in [self.hscaleDial, self.hoffsetDial] + self.scaleDials + self.offsDials:
+            dial.valueChanged.connect(self.requestSyncDialsSpins)
         
         # Timers
         self.loop_timer = QTimer()
+        self.loop_timer.setSingleShot(True)
         self.loop_timer.timeout.connect(self.measLoop)
-        self.loop_timer.setInterval(10)
-        self.loop_timer.start()
+        self.looping = True
+        self.loop_timer.start(self.loop_interval)
         
     def setup_graph(self):
         self.figure = plt.figure()
@@ -551,12 +486,13 @@ class VirtualOscilloscope(FormUI, WindowUI):
         self.graphHolder.addWidget(self.graph)
         self.graph_ax = self.figure.add_subplot()
         self.graph_lines = [None, None, None, None]
-        (self.graph_lines[0],) = self.graph_ax.plot([],[], 'o', markersize=1)
-        (self.graph_lines[1],) = self.graph_ax.plot([],[], 'o', markersize=1)
-        (self.graph_lines[2],) = self.graph_ax.plot([],[], 'o', markersize=1)
-        (self.graph_lines[3],) = self.graph_ax.plot([],[], 'o', markersize=1)
+        (self.graph_lines[0],) = self.graph_ax.plot([],[], '-', linewidth=0.8, markersize=2)
+        (self.graph_lines[1],) = self.graph_ax.plot([],[], '-', linewidth=0.8, markersize=2)
+        (self.graph_lines[2],) = self.graph_ax.plot([],[], '-', linewidth=0.8, markersize=2)
+        (self.graph_lines[3],) = self.graph_ax.plot([],[], '-', linewidth=0.8, markersize=2)
         for line in self.graph_lines:
             line.set_visible(False)
+            line.set_animated(True)
         self.graph_ax.set_xlim([self.timeoffs, self.timediv*10 + self.timeoffs])
         self.graph_ax.set_ylim([self.mastervscale[0], self.mastervscale[1]])
         self.graph_ax.xaxis.set_ticks(np.linspace(self.timeoffs, self.timediv*10 + self.timeoffs, 11), labels=["","","","","","","","","","",""])
@@ -567,8 +503,25 @@ class VirtualOscilloscope(FormUI, WindowUI):
         self.graph_ax.set_ylabel("Voltage (Div)")
         self.graph_ax.grid(True, which='minor', color='gainsboro')
         self.graph_ax.grid(True, which='major', color='gray')
+        self.graph.mpl_connect("draw_event", self.on_graph_draw)
         self.graph.draw()
 
+    # Keep the enabled channels cached, so the acquisition loop does not query the checkboxes every frame
+    def updateChannels(self):
+        self.channels_enabled = [check.isChecked() for check in self.channelsChecks]
+
+    # Show or hide a trace, only touching the artist when its state changes
+    def setLineVisible(self, i, visible):
+        if self.lines_visible[i] != visible:
+            self.lines_visible[i] = visible
+            self.graph_lines[i].set_visible(visible)
+
+    # After a full redraw, save the static background for blitting and draw the traces on top
+    def on_graph_draw(self, event):
+        self.graph_bg = self.graph.copy_from_bbox(self.graph_ax.bbox)
+        for line in self.graph_lines:
+            self.graph_ax.draw_artist(line)
+
     # Enable/disable vertical numbers in graph
     def change_vdivs(self):
         if self.showvdivCheck.isChecked():
@@ -615,23 +568,62 @@ class VirtualOscilloscope(FormUI, WindowUI):
             self.stopAcquisition()
             was_running = True
 
+        # Read the UI values only once
+        n_avg = self.avgSpin.value()
+        n_hold = self.holdSpin.value()
+
         # self.npoints = self.pointsSpin.value()
         self.display_points = self.pointsSpin.value()
-        self.x_axis = np.linspace(self.timeoffs, self.timeoffs + self.sampletime, self.npoints)
-        self.y_axis = np.zeros([4, self.npoints])
-        self.avg_buffer = np.zeros([4, self.avgSpin.value(), self.npoints])
-        self.hold_buffer = np.zeros([4, self.holdSpin.value(), self.npoints])
-        self.avg_counter = 0
+        # Show the individual samples only when there are few of them, markers are expensive to draw
+        marker = '.' if self.display_points < self.marker_max_points else ''
+        for line in self.graph_lines:
+            line.set_marker(marker)
+        self.y_axis = np.zeros([4, self.npoints], dtype=np.float32)
+        self.avg_sum = np.zeros([4, self.npoints])
+
+        # The ring buffers only grow, smaller depths use views of them
+        if self.avg_storage.shape[1] < n_avg:
+            self.avg_storage = np.zeros([4, n_avg, self.npoints], dtype=np.float32)
+        if self.hold_storage.shape[1] < n_hold:
+            self.hold_storage = np.zeros([4, n_hold, self.npoints], dtype=np.float32)
+        self.avg_buffer = self.avg_storage[:, :n_avg]
+        self.hold_buffer = self.hold_storage[:, :n_hold]
+
+        self.avg_counts = [0, 0, 0, 0]
         self.hold_counter = 0
+        self.avg_write_idx = [0, 0, 0, 0]
+        self.hold_write_idx = 0
+        self.setResampling(self.npoints)
+        self.setAxes()
+        self.x_axis = self.acq_x_axis
 
         # Get rid of empty average buffer
         for i in range(0, 4):
             data = self.input_channels(i)
-            self.avg_buffer[i] = np.tile(data, (self.avgSpin.value(), 1))
+            self.avg_buffer[i, :, :] = data
         
         if was_running:
             self.runAcquisition()
             
+    # Schedule a single setScales/syncDialsSpins call for all the changes in this event loop turn
+    def requestScales(self):
+        if not self.scales_pending:
+            self.scales_pending = True
+            QTimer.singleShot(0, self.applyScales)
+
+    def applyScales(self):
+        self.scales_pending = False
+        self.setScales()
+
+    def requestSyncDialsSpins(self):
+        if not self.sync_pending:
+            self.sync_pending = True
+            QTimer.singleShot(0, self.applySyncDialsSpins)
+
+    def applySyncDialsSpins(self):
+        self.sync_pending = False
+        self.syncDialsSpins()
+
     # Set oscilloscope scales
     def setScales(self):
         # Horizontal
@@ -649,89 +641,99 @@ class VirtualOscilloscope(FormUI, WindowUI):
         self.ch2offsDial.setValue(int(self.ch2offsSpin.value()*1000.0))
         self.ch3offsDial.setValue(int(self.ch3offsSpin.value()*1000.0))
         self.ch4offsDial.setValue(int(self.ch4offsSpin.value()*1000.0))
+
+        self.setAxes()
     
     # Sync spin boxes values to dials and sliders values
     def syncDialsSpins(self):
         # Horizontal
         horiz_list = [1e-12, 2e-12, 5e-12]
-        hmultiplier = 10**(np.floor(self.hscaleDial.value()/3))
+        hmultiplier = 10.0**math.floor(self.hscaleDial.value()/3)
         hvalue = horiz_list[int(self.hscaleDial.value() % 3)]
         self.timediv = hvalue*hmultiplier
         self.sampletime = 10*self.timediv
         self.hscaleInd.setText(f"{self.float2SI(self.timediv)}s")
         self.hoffsetSpin.setValue(self.hoffsetDial.value()/100.0)
         
-        # Vertical
-        vert_list = [1e-4, 2e-4, 5e-4]
-        
-        # CH1
-        vmultiplier = 10**(np.floor(self.ch1scaleDial.value()/3))
-        vvalue = vert_list[int(self.ch1scaleDial.value() % 3)]
-        vdiv = vvalue*vmultiplier
-        self.ch1scaleInd.setText(f"{self.float2SI(vdiv)}V")
-        self.ch1offsSpin.setValue(self.ch1offsDial.value()/1000.0)
-        self.voltdivs[0] = vdiv
-        
-        # CH2
-        multiplier = 10**(np.floor(self.ch2scaleDial.value()/3))
-        value = vert_list[int(self.ch2scaleDial.value() % 3)]
-        vdiv = value*multiplier
-        self.ch2scaleInd.setText(f"{self.float2SI(vdiv)}V")
-        self.ch2offsSpin.setValue(self.ch2offsDial.value()/1000.0)
-        self.voltdivs[1] = vdiv
-        
-        # CH3
-        multiplier = 10**(np.floor(self.ch3scaleDial.value()/3))
-        value = vert_list[int(self.ch3scaleDial.value() % 3)]
-        vdiv = value*multiplier
-        self.ch3scaleInd.setText(f"{self.float2SI(vdiv)}V")
-        self.ch3offsSpin.setValue(self.ch3offsDial.value()/1000.0)
-        self.voltdivs[2] = vdiv
-        
-        # CH4
-        multiplier = 10**(np.floor(self.ch4scaleDial.value()/3))
-        value = vert_list[int(self.ch4scaleDial.value() % 3)]
-        vdiv = value*multiplier
-        self.ch4scaleInd.setText(f"{self.float2SI(vdiv)}V")
-        self.ch4offsSpin.setValue(self.ch4offsDial.value()/1000.0)
-        self.voltdivs[3] = vdiv
+        # Vertical, all channels at once
+        vert_list = np.array([1e-4, 2e-4, 5e-4])
+        dials = np.array([dial.value() for dial in self.scaleDials])
+        self.voltdivs[:] = vert_list[dials % 3]*10.0**(dials//3)
+        for i in range(0, 4):
+            self.scaleInds[i].setText(f"{self.float2SI(self.voltdivs[i])}V")
+            self.offsSpins[i].setValue(self.offsDials[i].value()/1000.0)
         
         self.voltscales = self.voltdivs*10
+        self.setAxes()
 
 
     # Internal functions
     # Helper to convert scientific notation to readable number with appropriate unit
     def float2SI(self, number):
-        units = {  0:' ',
-           1:'K',  2:'M',  3:'G',  4:'T',  5:'P',  6:'E',  7:'Z',  8:'Y',  9:'R',  10:'Q',
-          -1:'m', -2:'u', -3:'n', -4:'p', -5:'f', -6:'a', -7:'z', -8:'y', -9:'r', -10:'q'
-        }
-         
-        mantissa,exponent = f"{number:e}".split("e")
-        unitRange         = int(exponent)//3                        
-        unit              = units.get(unitRange,None)
-        unitValue         = float(mantissa)*10**(int(exponent)%3)
+        # The small offset keeps values like 0.99999999e-3 in the right decade
+        exponent  = math.floor(math.log10(abs(number)) + 1e-9) if number else 0
+        unitRange = exponent//3
+        unit      = SI_UNITS.get(unitRange, None)
+        unitValue = number/10**(3*unitRange)
         return f"{unitValue:.0f} {unit}" if unit else f"{number:.5e}"
     
+    # Rebuild the time axes and the graph ticks, these only change with the scales and number of points
+    def setAxes(self):
+        self.acq_x_axis = np.linspace(self.timeoffs, self.timeoffs + self.sampletime, self.npoints)
+        self.show_x_axis = np.linspace(self.timeoffs, self.timeoffs + self.sampletime, self.display_points)
+        self.x_ticks = np.linspace(self.timeoffs, self.timediv*10 + self.timeoffs, 11)
+        self.y_ticks = np.linspace(self.mastervscale[0], self.mastervscale[1], 11)
+        if self.show_data.shape[1] != self.display_points:
+            self.show_data = np.zeros((4, self.display_points), dtype=np.float32)
+        self.axes_dirty = True
+
+    # Precompute the linear resampling table from n_src acquired points to the displayed points
+    # Both axes are linspaces over the same span, so the mapping is fixed until the sizes change
+    def setResampling(self, n_src):
+        t = np.linspace(0, n_src - 1, self.display_points)
+        self.rs_idx = np.minimum(t.astype(np.intp), n_src - 2)
+        self.rs_w = (t - self.rs_idx).astype(np.float32)
+        self.rs_npoints = n_src
+
+    # Resample acquired data to the displayed points
+    def resample(self, data):
+        if len(data) != self.rs_npoints:
+            self.setResampling(len(data))
+        return data[self.rs_idx]*(1.0 - self.rs_w) + data[self.rs_idx + 1]*self.rs_w
+
     # Acquisition loop
+    # The loop timer is single shot, and re-armed only when a frame is done, so frames never stack up
     def measLoop(self):
-        if not self.busy and self.running:
-            # Set soft lock
-            self.busy = True
+        frame_start = time.time()
+        try:
+            if not self.running:
+                return
+
+            # Read the UI values only once per frame
+            hold_on = self.holdCheck.isChecked()
+            trig_auto = self.triggerautoRadio.isChecked()
+            n_avg = self.avgSpin.value()
+            n_hold = self.holdSpin.value()
+            enabled = self.channels_enabled
             
             # Create arrays
-            self.x_axis = np.linspace(self.timeoffs, self.timeoffs + self.sampletime, self.npoints)  
-            show_x_axis = np.linspace(self.timeoffs, self.timeoffs + self.sampletime, self.display_points)
-            show_data = np.zeros((4, self.display_points))
-            if self.holdCheck.isChecked():
-                self.x_axis = np.tile(self.x_axis, self.hold_counter + 1)
-                self.y_axis = np.zeros([4, self.display_points*(self.hold_counter + 1)])
+            self.x_axis = self.acq_x_axis
+            show_data = self.show_data
+            if hold_on:
+                # Held frames are chained, only reallocate while the hold buffer is filling up
+                n_held = self.npoints*(self.hold_counter + 1)
+                if len(self.hold_x_axis) != n_held or self.hold_x_base is not self.acq_x_axis:
+                    self.hold_x_axis = np.tile(self.acq_x_axis, self.hold_counter + 1)
+                    self.hold_x_base = self.acq_x_axis
+                if self.y_axis.shape[1] != n_held:
+                    self.y_axis = np.zeros([4, n_held], dtype=np.float32)
+                self.x_axis = self.hold_x_axis
             
             # Sweep channels
             for i in range(0, len(self.input_objs)):
-                if self.channelsChecks[i].isChecked() and self.input_objs[i]:
+                if enabled[i] and self.input_objs[i]:
                     # Adjust phase to simulate trigger (and time offset)
-                    if self.triggerautoRadio.isChecked():
+                    if trig_auto:
                         freq = self.input_objs[i].freq
                         argument = 2*np.pi*freq*self.timeoffs
                         self.input_objs[i].t0 = argument
@@ -742,65 +744,75 @@ class VirtualOscilloscope(FormUI, WindowUI):
                     new_data = self.input_channels(i)
 
                     # If hold is enabled, hold data
-                    if self.holdCheck.isChecked():
-                        self.hold_buffer[i] = np.concatenate(([new_data], self.hold_buffer[i][0:-1]))
-                        self.y_axis[i] = np.concatenate(self.hold_buffer[i][0:self.hold_counter + 1])
+                    if hold_on:
+                        update_and_hold(self.hold_buffer[i], new_data, self.hold_write_idx, self.hold_counter + 1, self.y_axis[i])
                     # If not, perform averaging
-                    elif self.avgSpin.value() > 1:
-                        self.avg_buffer[i] = np.concatenate(([new_data], self.avg_buffer[i][0:-1]))
-                        self.y_axis[i] = self.avg_buffer[i][0:self.avg_counter + 1].mean(axis=0)
+                    elif n_avg > 1:
+                        self.y_axis[i] = update_and_average(self.avg_buffer[i], self.avg_sum[i], new_data, self.avg_write_idx[i], self.avg_counts[i])
+                        self.avg_write_idx[i] = (self.avg_write_idx[i] + 1) % n_avg
+                        self.avg_counts[i] = min(self.avg_counts[i] + 1, n_avg)
                     else:
                         self.y_axis[i] = new_data
 
                     # Resample data
-                    show_data_interp = interp1d(self.x_axis, self.y_axis[i], kind='cubic')
-                    show_data[i] = show_data_interp(show_x_axis)
+                    show_data[i] = self.resample(self.y_axis[i])
 
                     # Update plot
-                    self.graph_lines[i].set_ydata((show_data[i] + self.voffsets[i])/self.voltdivs[i])
-                    self.graph_lines[i].set_xdata(show_x_axis)
-                    self.graph_lines[i].set_visible(True)
+                    self.graph_lines[i].set_data(self.show_x_axis, (show_data[i] + self.voffsets[i])/self.voltdivs[i])
+                    self.setLineVisible(i, True)
                 else:
-                    self.graph_lines[i].set_visible(False)
+                    self.setLineVisible(i, False)
 
-            self.graph_ax.set_xlim([self.timeoffs, self.timediv*10 + self.timeoffs])
-            self.graph_ax.set_ylim([self.mastervscale[0], self.mastervscale[1]])
-            self.graph_ax.xaxis.set_ticks(np.linspace(self.timeoffs, self.timediv*10 + self.timeoffs, 11))
-            self.graph_ax.yaxis.set_ticks(np.linspace(self.mastervscale[0], self.mastervscale[1], 11))
-            self.graph_ax.set_xlabel("Time (s)")
-            self.graph_ax.set_ylabel("Voltage (Div)")
+            # Only touch the axes when the scales or the XY mode changed
+            ch = self.xy_x - 1
+            xy_active = bool(self.xymode and enabled[ch] and self.input_objs[ch])
+            redraw = self.axes_dirty or xy_active != self.axes_xy
+            if redraw:
+                self.graph_ax.set_ylim([self.mastervscale[0], self.mastervscale[1]])
+                self.graph_ax.yaxis.set_ticks(self.y_ticks)
+                self.graph_ax.set_ylabel("Voltage (Div)")
+                if xy_active:
+                    self.graph_ax.set_xlim([self.mastervscale[0], self.mastervscale[1]])
+                    self.graph_ax.xaxis.set_ticks(self.y_ticks, labels=["","","","","","","","","","",""])
+                    self.graph_ax.set_xlabel(f"CH{ch + 1} Voltage (Div)")
+                else:
+                    self.graph_ax.set_xlim([self.timeoffs, self.timediv*10 + self.timeoffs])
+                    self.graph_ax.xaxis.set_ticks(self.x_ticks)
+                    self.graph_ax.set_xlabel("Time (s)")
+                self.axes_dirty = False
+                self.axes_xy = xy_active
 
             # After getting all data, change plots to XY mode if enabled
-            ch = self.xy_x - 1
-            if self.xymode and self.channelsChecks[ch].isChecked() and self.input_objs[ch]:
+            if xy_active:
+                new_x = (show_data[ch] + self.voffsets[ch])/self.voltdivs[ch]
                 for i in range(0, len(self.input_objs)):
-                    if self.channelsChecks[i].isChecked() and self.input_objs[i] and i != ch:
-                        new_x = (show_data[ch] + self.voffsets[ch])/self.voltdivs[ch]
+                    if enabled[i] and self.input_objs[i] and i != ch:
                         self.graph_lines[i].set_xdata(new_x)
-                        self.graph_lines[i].set_visible(True)
-                        self.graph_ax.set_xlim([self.mastervscale[0], self.mastervscale[1]])
-                        self.graph_ax.xaxis.set_ticks(np.linspace(self.mastervscale[0], self.mastervscale[1], 11), labels=["","","","","","","","","","",""])
-                    elif self.channelsChecks[i].isChecked() and self.input_objs[i] and i == ch:
-                        self.graph_lines[i].set_visible(False)
-                
-                self.graph_ax.set_xlabel(f"CH{ch + 1} Voltage (Div)")
-                self.graph_ax.set_ylabel("Voltage (Div)")
+                    elif enabled[i] and self.input_objs[i] and i == ch:
+                        self.setLineVisible(i, False)
             
-            self.graph.draw()
+            # Full redraw only when the axes changed, otherwise blit just the traces over the background
+            if redraw:
+                self.graph.draw()
+            else:
+                self.graph.restore_region(self.graph_bg)
+                for line in self.graph_lines:
+                    self.graph_ax.draw_artist(line)
+                self.graph.blit(self.graph_ax.bbox)
             self.graph.flush_events()
 
             # Update counters
-            if self.holdCheck.isChecked():
+            if hold_on:
+                self.hold_write_idx = (self.hold_write_idx + 1) % n_hold
                 self.hold_counter += 1
-                if self.hold_counter >= self.holdSpin.value():
-                    self.hold_counter = self.holdSpin.value() - 1
-            elif self.avgSpin.value() > 1:
-                self.avg_counter += 1
-                if self.avg_counter >= self.avgSpin.value():
-                    self.avg_counter = self.avgSpin.value() - 1
-            
-            # Release soft lock
-            self.busy = False
+                if self.hold_counter >= n_hold:
+                    self.hold_counter = n_hold - 1
+            self.frame_count += 1
+        finally:
+            # Re-arm the timer, right away if the frame took longer than the interval
+            if self.looping:
+                behind = (time.time() - frame_start)*1000 >= self.loop_interval
+                self.loop_timer.start(0 if behind else self.loop_interval)
 
     # Save data
     def saveData(self):
@@ -815,22 +827,16 @@ class VirtualOscilloscope(FormUI, WindowUI):
             if filename[-4:] != ".txt" and filename[-4:] != ".TXT":
                 filename = filename + ".txt"   
 
-            with open(filename, "w") as file:
-                file.write("Time(s)\t")
-                for j in range(0, len(self.input_objs)):
-                    if self.channelsChecks[j].isChecked():
-                        file.write(f"CH{j + 1}(V)\t")
-                file.write("\n")
-
-                for i in range(len(self.y_axis[0])):
-                    file.write(f"{self.x_axis[i]}\t")
-                    for j in range(0, len(self.input_objs)):
-                        if self.channelsChecks[j].isChecked():
-                            file.write(f"{self.y_axis[j][i]}")
-                            if j < len(self.input_objs) - 1:
-                                file.write("\t")
-                    file.write("\n")
-                file.close()
+            # Write time and active channels as columns in a single pass
+            active = [j for j in range(0, len(self.input_objs)) if self.channelsChecks[j].isChecked()]
+            header = "\t".join(["Time(s)"] + [f"CH{j + 1}(V)" for j in active])
+            npts = len(self.y_axis[0])
+            table = np.column_stack([self.x_axis[:npts]] + [self.y_axis[j] for j in active])
+            # The table is a copy, so acquisition can resume while it is written
+            if self.saver is not None:
+                self.saver.wait()
+            self.saver = DataSaver(filename, table, header, ["%.15g"] + ["%.9g"]*len(active))
+            self.saver.start()
 
         if was_running:
             self.runAcquisition()
@@ -847,7 +853,7 @@ class VirtualOscilloscope(FormUI, WindowUI):
     # Input functions: all parameters and instrument inputs are processed here. These are active (calls the output from other instruments)
     # Total time of the output wave
     def input_channels(self, channel):
-        if self.input_objs[channel] and self.channelsChecks[channel].isChecked():
+        if self.input_objs[channel] and self.channels_enabled[channel]:
             data = self.input_objs[channel].output_signal()
         else:
             data = np.zeros([self.npoints])
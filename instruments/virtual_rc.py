@@ -5,10 +5,11 @@
 
 import os
 import time
+import math
+import functools
 import numpy as np
-from scipy.integrate import odeint
-from scipy.fft import fft, ifft, fftfreq
-from scipy.signal import windows
+from scipy.fft import rfft, irfft, rfftfreq
+from scipy.signal import windows, lfilter
 from PyQt6 import uic
 from PyQt6.QtGui import QPixmap
 from instruments.virtual_socketinstrument import VirtualSocketInstrument
@@ -21,36 +22,61 @@ thisfile = os.path.basename(__file__)
 FormUI, WindowUI = uic.loadUiType(f"{main_path}/virtual_rc.ui")
 
 # Misc Functions
-# FFT
+# Kaiser window, cached per (n, beta) and read-only since it is shared between calls
+@functools.lru_cache(maxsize=8)
+def _kaiser(n, beta):
+    w = windows.kaiser(n, beta)
+    w.setflags(write=False)
+    return w
+
+# FFT (real input, so only the non-negative half of the spectrum is computed)
 def do_fft(wls, data, window=False, beta=0.0):
     yf = []
     n = len(data)
     if window:
-        w = windows.kaiser(n, beta)
-        yf = fft(data*w)
+        w = _kaiser(n, beta)
+        yf = rfft(data*w, workers=-1, overwrite_x=True)
     else:
-        yf = fft(data)
+        yf = rfft(data, workers=-1)
 
     delta = wls[1] - wls[0]
-    xf = fftfreq(n, delta)
+    xf = rfftfreq(n, delta)
 
     return xf[:n//2], (2.0/n)*np.abs(yf[:n//2]), xf, yf
 
-def do_ifft(f_raw, yf_raw, cut_l, cut_h, slope=90.0):
-    yf_raw[((np.abs(f_raw) > cut_h) | (np.abs(f_raw) < cut_l))] = yf_raw[((np.abs(f_raw) > cut_h) | (np.abs(f_raw) < cut_l))]*(np.abs(f_raw[((np.abs(f_raw) > cut_h) | (np.abs(f_raw) < cut_l))])/cut_h)**(-slope/10)
-    y = np.real(ifft(yf_raw))
+def do_ifft(f_raw, yf_raw, cut_l, cut_h, slope=90.0, n=None):
+    # Build the out-of-band mask once and attenuate those bins in place (rfftfreq is already non-negative)
+    mask = (f_raw > cut_h) | (f_raw < cut_l)
+    yf_raw[mask] *= (f_raw[mask]/cut_h)**(-slope/10)
+    y = irfft(yf_raw, n, workers=-1, overwrite_x=True)
 
-    if min(y) < 0:
-        y = y - min(y)
+    # irfft output is real and freshly allocated, so shift it in place if it went negative
+    y_min = y.min()
+    if y_min < 0:
+        y -= y_min
 
-    return np.real(y)
+    return y
 
 def fft_filter(x_data, y_data, l_pass, h_pass=0.0, slope=90.0):
     # Do fft
     x_fft, y_fft, f_raw, yf_raw = do_fft(x_data, y_data)
 
     # Do ifft to remove undesired interference
-    return do_ifft(f_raw, yf_raw, h_pass, l_pass, slope)
+    return do_ifft(f_raw, yf_raw, h_pass, l_pass, slope, len(y_data))
+
+# RC response: exact solution of dvc/dt = (v - vc)/rc for an input held constant over each step,
+# i.e. vc[i] = vc[i-1]*alpha + v[i]*(1 - alpha), with alpha = exp(-dt/rc) and vc[0] = 0
+# Writes the capacitor voltage into out, or the resistor voltage (v_r_ref - vc) if a reference for it is given
+def rc_response(data, dt, rc, v_r_ref=None, out=None):
+    alpha = math.exp(-dt/rc)
+    if out is None:
+        out = np.empty(len(data), dtype=np.float32)
+    out[0] = 0.0
+    if len(data) > 1:
+        out[1:] = lfilter([1.0 - alpha], [1.0, -alpha], data[1:])
+    if v_r_ref is not None:
+        np.subtract(v_r_ref, out, out=out)
+    return out
     
 
 # Communications class
@@ -59,6 +85,10 @@ class VirtualRCComms(VirtualSocketInstrument):
         super().__init__(verbose)
         self.dev = dev
 
+        # Widgets used by the commands, bound once
+        self._cspin = dev.cSpin
+        self._rspin = dev.rSpin
+
         # Commands dictionaries
         # Instrument functions
         # Root commands
@@ -73,9 +103,9 @@ class VirtualRCComms(VirtualSocketInstrument):
         return "PFJ Systems Inc., Virtual RC Circuit VRC1, S/N R0934567"
     
     def get_output(self, args):
-        if self.dev.outCRadio.isChecked():
+        if self.dev.measC:
             return "C"
-        if self.dev.outRRadio.isChecked():
+        if self.dev.measR:
             return "R"
     
     def set_output(self, args):
@@ -90,24 +120,22 @@ class VirtualRCComms(VirtualSocketInstrument):
                 
                 
     def get_c(self, args):
-        return f"{self.dev.cSpin.value()}"
+        return f"{self._cspin.value()}"
     
     def set_c(self, args):
         try:
             if args:
-                val = float(args[0])
-                self.dev.cSpin.setValue(val)
+                self._cspin.setValue(float(args[0]))
         except:
             pass
     
     def get_r(self, args):
-        return f"{self.dev.rSpin.value()}"
+        return f"{self._rspin.value()}"
     
     def set_r(self, args):
         try:
             if args:
-                val = float(args[0])
-                self.dev.rSpin.setValue(val)
+                self._rspin.setValue(float(args[0]))
         except:
             pass
 
@@ -129,9 +157,10 @@ class VirtualRC(FormUI, WindowUI):
     measC = True
 
     # Waveform holder
-    wf = np.zeros(npoints)
-    data = np.zeros(npoints)
+    wf = np.zeros(npoints, dtype=np.float32)
+    data = np.zeros(npoints, dtype=np.float32)
     t_array = np.zeros(npoints)
+    zeros = np.zeros(npoints, dtype=np.float32)
 
     # Default functions
     def __init__(self, verbose=False):
@@ -144,6 +173,11 @@ class VirtualRC(FormUI, WindowUI):
         self.setupActions()
         self.comms = VirtualRCComms(self, verbose)
 
+        # Per-instance buffers, reused between frames
+        self.wf = np.zeros(self.npoints, dtype=np.float32)
+        self.zeros = np.zeros(self.npoints, dtype=np.float32)
+        self.zeros.setflags(write=False)
+
         self.show()
 
     def __del__(self):
@@ -155,45 +189,23 @@ class VirtualRC(FormUI, WindowUI):
 
     # Other functions
     def interp_value(self, ref_val, ref_array, val_array):
-        ref_idx = np.abs(ref_array - ref_val).argmin()
-        ref_idx_r = ref_idx + 1
-        ref_idx_l = ref_idx - 1
-        if ref_idx_r >= len(ref_array):
-            # Linear interpolation
-            li_a = (val_array[ref_idx] - val_array[ref_idx_l])/(ref_array[ref_idx] - ref_array[ref_idx_l])
-            val = val_array[ref_idx_l] + li_a*(ref_val - ref_array[ref_idx_l])
-        elif ref_idx_l < 0:
+        # ref_array is monotonic, so the bracketing points come from a binary search
+        n = len(ref_array)
+        ref_idx = int(np.searchsorted(ref_array, ref_val))
+        if n < 3:
             # Linear interpolation
-            li_a = (val_array[ref_idx_r] - val_array[ref_idx])/(ref_array[ref_idx_r] - ref_array[ref_idx])
-            val = val_array[ref_idx] + li_a*(ref_val - ref_array[ref_idx])
-        else:
-            try:
-                # Quadratic interpolation
-                qi_x1 = ref_array[ref_idx_l]
-                qi_x2 = ref_array[ref_idx]
-                qi_x3 = ref_array[ref_idx_r]
-                qi_y1 = val_array[ref_idx_l]
-                qi_y2 = val_array[ref_idx]
-                qi_y3 = val_array[ref_idx_r]
-                qi_A = np.array([[1, qi_x1, qi_x1**2],[1, qi_x2, qi_x2**2],[1, qi_x3, qi_x3**2]])
-                qi_B = np.array([qi_y1, qi_y2, qi_y3])
-                coefs = np.linalg.solve(qi_A, qi_B)
-                val = coefs[0] + coefs[1]*ref_val + coefs[2]*(ref_val**2)
-            except:
-                # Linear interpolation
-                li_a = (val_array[ref_idx_r] - val_array[ref_idx])/(ref_array[ref_idx_r] - ref_array[ref_idx])
-                val = val_array[ref_idx] + li_a*(ref_val - ref_array[ref_idx])
-        return val
-
-    def model(self, vc, t):
-        r = self.rSpin.value()
-        c = 1e-6*self.cSpin.value()
-        rc = r*c
-        
-        t_idx = np.abs(self.t_array - t).argmin()
-        v_t = self.data[t_idx]
-        
-        return ((v_t - vc)/rc)
+            x1, x2 = ref_array[0], ref_array[-1]
+            y1, y2 = val_array[0], val_array[-1]
+            return y1 + (y2 - y1)*(ref_val - x1)/(x2 - x1)
+
+        # Quadratic interpolation (Lagrange form) on the three points around ref_val
+        ref_idx = min(max(ref_idx, 1), n - 2)
+        x1, x2, x3 = ref_array[ref_idx - 1], ref_array[ref_idx], ref_array[ref_idx + 1]
+        y1, y2, y3 = val_array[ref_idx - 1], val_array[ref_idx], val_array[ref_idx + 1]
+        l1 = (ref_val - x2)*(ref_val - x3)/((x1 - x2)*(x1 - x3))
+        l2 = (ref_val - x1)*(ref_val - x3)/((x2 - x1)*(x2 - x3))
+        l3 = (ref_val - x1)*(ref_val - x2)/((x3 - x1)*(x3 - x2))
+        return l1*y1 + l2*y2 + l3*y3
 
     
     # UI functions
@@ -216,26 +228,35 @@ class VirtualRC(FormUI, WindowUI):
 
     # Circuit functions
     def get_waveform(self, data):
-        self.t_array = np.linspace(0.0, self.sampletime, len(data))
+        # Time axis and output buffer only change with the number of points or the sample time
+        if len(self.t_array) != len(data) or self.t_array[-1] != self.sampletime:
+            self.t_array = np.linspace(0.0, self.sampletime, len(data))
+        if len(self.wf) != len(data):
+            self.wf = np.zeros(len(data), dtype=np.float32)
         r = self.rSpin.value()
         c = 1e-6*self.cSpin.value()
         
-        if np.any(data):
-            data = fft_filter(self.t_array, data, 8*(1/(2*np.pi*r*c)), slope=30.0)
-            vc_0 = 0.0
-            vc_sol = odeint(self.model, vc_0, self.t_array)[:,0]
+        # Ask the source whether it outputs anything, and only scan the data if it cannot tell
+        has_signal = getattr(self.main_input, "has_signal", None) if self.main_input else False
+        if has_signal is None:
+            has_signal = data.any()
+
+        if has_signal:
+            dt = self.t_array[1] - self.t_array[0] if len(data) > 1 else self.sampletime
+            # The capacitor is driven by the raw input, the filtered (non-negative) input is only the reference
+            # for the resistor voltage. The input filter does nothing to the spectrum when its cutoff is above Nyquist
+            v_r_ref = None
+            if self.measR:
+                cutoff = 8.0/(2*math.pi*r*c)
+                if cutoff < 0.5/dt:
+                    v_r_ref = fft_filter(self.t_array, data, cutoff, slope=30.0)
+                elif data.min() < 0:
+                    v_r_ref = data - data.min()
+                else:
+                    v_r_ref = data
+            rc_response(data, dt, r*c, v_r_ref, self.wf)
         else:
-            vc_sol = np.zeros(len(data))
-
-        v_array_c = vc_sol
-        v_array_r = data - v_array_c
-
-        if self.measR:
-            return_array = v_array_r
-        elif self.measC:
-            return_array = v_array_c
-        
-        self.wf = return_array
+            self.wf.fill(0.0)
 
     # I/O functions
     # Start communication server
@@ -268,6 +289,8 @@ class VirtualRC(FormUI, WindowUI):
             npoints = 1000
         if npoints != self.npoints:
             self.npoints = npoints
+            self.zeros = np.zeros(npoints, dtype=np.float32)
+            self.zeros.setflags(write=False)
     
     def input_channel(self):
         if self.main_input:
@@ -275,7 +298,7 @@ class VirtualRC(FormUI, WindowUI):
             self.main_input.add_noise = False
             data = self.main_input.output_signal()
         else:
-            data = np.zeros([self.npoints])
+            data = self.zeros
 
         return data
 
@@ -296,8 +319,6 @@ class VirtualRC(FormUI, WindowUI):
         self.input_sampletime()
         self.input_npoints()
 
-        self.wf = np.zeros([self.npoints])
-
         # Get data
         self.data = self.input_channel()
         self.get_waveform(self.data)
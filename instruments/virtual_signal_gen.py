@@ -5,8 +5,9 @@
 # By pfjarschel, 2021
 
 # Imports
-import os, time
+import os, time, bisect, threading
 import numpy as np
+from scipy.signal import oaconvolve
 from instruments.virtual_socketinstrument import VirtualSocketInstrument
 from PyQt6 import uic
 
@@ -17,12 +18,22 @@ thisfile = os.path.basename(__file__)
 # Load ui file
 FormUI, WindowUI = uic.loadUiType(f"{main_path}/virtual_signal_gen.ui")
 
+# Frequency and amplitude ranges: a value up to (and including) each break goes in the matching range
+FREQ_BREAKS = [10.0, 1e3, 100e3, 10e6, 1e9]
+FREQ_RANGES = [1.0, 100.0, 10e3, 1e6, 100e6, 1e9]
+AMP_BREAKS = [10e-3, 100e-3, 1.0, 10.0]
+AMP_RANGES = [1e-3, 10e-3, 100e-3, 1.0, 10.0]
+
 # Communications class
 class VirtualSignalGenComms(VirtualSocketInstrument):
     def __init__(self, dev, verbose=False):
         super().__init__(verbose)
         self.dev = dev
 
+        # Range selectors, in the order of FREQ_RANGES and AMP_RANGES
+        self.freq_checks = [dev.f1hzCheck, dev.f100hzCheck, dev.f10khzCheck, dev.f1mhzCheck, dev.f100mhzCheck, dev.f1ghzCheck]
+        self.amp_checks = [dev.a1mvCheck, dev.a10mvCheck, dev.a100mvCheck, dev.a1vCheck, dev.a10vCheck]
+
         # Commands dictionaries
         self.comms_freq = {}
         self.comms_amp = {}
@@ -84,29 +95,25 @@ class VirtualSignalGenComms(VirtualSocketInstrument):
         try:
             if args:
                 val = float(args[0])
-                mult = self.dev.fmultSpin.value()
-                if val <= 10.0:
-                    mult = val/1.0
-                    self.dev.f1hzCheck.setChecked(True)
-                if (val > 10.0) and (val <= 1e3):
-                    mult = val/100.0
-                    self.dev.f100hzCheck.setChecked(True)
-                if (val > 1e3) and (val <= 100e3):
-                    mult = val/10e3
-                    self.dev.f10khzCheck.setChecked(True)
-                if (val > 100e3) and (val <= 10e6):
-                    mult = val/1e6
-                    self.dev.f1mhzCheck.setChecked(True)
-                if (val > 10e6) and (val <= 1e9):
-                    mult = val/100e6
-                    self.dev.f100mhzCheck.setChecked(True)
-                if val > 1e9:
-                    mult = val/1e9
-                    self.dev.f1ghzCheck.setChecked(True)
-                self.dev.fmultSpin.setValue(mult)
+                idx = bisect.bisect_left(FREQ_BREAKS, val)
+                self.set_range(self.freq_checks, idx, self.dev.fmultSpin, val/FREQ_RANGES[idx])
         except:
             pass
 
+    # Set a range checkbox and its multiplier silently (all the range checkboxes, since checking one unchecks
+    # the others), then update the generator once
+    def set_range(self, checks, idx, mult_spin, mult):
+        widgets = checks + [mult_spin]
+        for widget in widgets:
+            widget.blockSignals(True)
+        try:
+            checks[idx].setChecked(True)
+            mult_spin.setValue(mult)
+        finally:
+            for widget in widgets:
+                widget.blockSignals(False)
+        self.dev.setParameters()
+
     def get_chirp(self, args):
         return f"{int(self.dev.chirpCheck.isChecked())}"
     
@@ -147,23 +154,8 @@ class VirtualSignalGenComms(VirtualSocketInstrument):
         try:
             if args:
                 val = float(args[0])
-                mult = self.dev.amultSpin.value()
-                if val <= 10e-3:
-                    mult = val/1e-3
-                    self.dev.a1mvCheck.setChecked(True)
-                if (val > 10e-3) and (val <= 100e-3):
-                    mult = val/10e-3
-                    self.dev.a10mvCheck.setChecked(True)
-                if (val > 100e-3) and (val <= 1.0):
-                    mult = val/100e-3
-                    self.dev.a100mvCheck.setChecked(True)
-                if (val > 1.0) and (val <= 10.0):
-                    mult = val/1.0
-                    self.dev.a1vCheck.setChecked(True)
-                if val > 10.0:
-                    mult = val/10.0
-                    self.dev.a10vCheck.setChecked(True)
-                self.dev.amultSpin.setValue(mult)
+                idx = bisect.bisect_left(AMP_BREAKS, val)
+                self.set_range(self.amp_checks, idx, self.dev.amultSpin, val/AMP_RANGES[idx])
         except:
             pass
 
@@ -277,6 +269,9 @@ class VirtualSignalGenerator(FormUI, WindowUI):
     noiselevel = 5*min_amplitude
     jitter = 20e-12
     phase = 0.0
+    chirp_on = False
+    chirp_var = 0.0
+    chirp_per = 1.0
     output_enabled = False
     timemult = 1.0
     impedance = 50.0
@@ -290,6 +285,21 @@ class VirtualSignalGenerator(FormUI, WindowUI):
 
     # Waveform holder
     wf = []
+
+    # Waveform samples are float32; time and phase stay float64, since the argument can span many periods
+    # Wavetables, one period of each periodic wave at unit amplitude (size is a power of 2, so the phase wraps with a mask)
+    lut_size = 4096
+    luts = {}
+    lut = None
+
+    # Derived time parameters, and the inputs they were last built for
+    npoints_ext = npoints
+    sampletime_ext = sampletime
+    params_key = None
+
+    # Risetime filter windows, by length, and the length from which they are applied with FFTs
+    windows = {}
+    fft_filter_min = 32
     
     # Default functions
     def __init__(self, verbose=False):
@@ -298,6 +308,8 @@ class VirtualSignalGenerator(FormUI, WindowUI):
         print("Initializing signal generator")
         self.t0 = time.time()  # Will be the phase of the output wave
         self.tref = time.time()  # Initial time for chirp calc
+        self.rng = np.random.default_rng()  # Own generator, independent of the global NumPy state
+        self.wf_lock = threading.RLock()  # Guards the shared work buffers, used by the GUI and the SCPI threads
         self.refresh_params()  # Recalculate some parameters
 
         self.setupUi(self)
@@ -349,6 +361,10 @@ class VirtualSignalGenerator(FormUI, WindowUI):
         self.offsetSlider.valueChanged.connect(self.syncDialsSpins)
         self.dutySlider.valueChanged.connect(self.syncDialsSpins)
         self.phaseSlider.valueChanged.connect(self.syncDialsSpins)
+        self.chirpCheck.toggled.connect(self.setChirp)
+        self.chirpvarSpin.valueChanged.connect(self.setChirp)
+        self.chirptSpin.valueChanged.connect(self.setChirp)
+        self.setChirp()
 
 
     def toggleOutput(self):
@@ -367,6 +383,12 @@ class VirtualSignalGenerator(FormUI, WindowUI):
         self.dutySpin.setValue(self.dutySlider.value()/100.0)
         self.phaseSpin.setValue(self.phaseSlider.value()/100.0)
 
+    # Keep the chirp settings as plain values, so get_waveform does not query the widgets every frame
+    def setChirp(self):
+        self.chirp_on = self.chirpCheck.isChecked()
+        self.chirp_var = self.chirpvarSpin.value()/100.0
+        self.chirp_per = self.chirptSpin.value()
+
     def setParameters(self):
         # Set Frequency
         frange = 1.0
@@ -435,81 +457,155 @@ class VirtualSignalGenerator(FormUI, WindowUI):
         self.phaseSlider.setValue(int(self.phaseSpin.value()*100.0))
 
     # Internal functions    
-    # Create full waveform
-    def get_waveform(self):
-        wf = np.zeros([self.totnpoints])
+    # Shaped and risetime filtered wave, without noise and offset
+    # Works in the shared buffers, so it must be called with wf_lock held (the result is a new array)
+    def shape_waveform(self):
+        wf = self.wf_buf
         phase = self.t0 % (2*np.pi) + self.phase
 
         # Add some jitter
-        jitter = np.random.uniform(-self.jitter/2, self.jitter/2)
+        jitter = self.rng.uniform(-self.jitter/2, self.jitter/2)
 
         # Chirped frequency
         freq = self.freq
-        if self.chirpCheck.isChecked():
+        if self.chirp_on:
             t = time.time() - self.tref
-            freq = self.freq*(1 + (self.chirpvarSpin.value()/100.0)*np.sin(2*np.pi*t/self.chirptSpin.value()))
-
-        # Calculate argument
-        argument = 2*np.pi*freq*(self.exttimearray + jitter) + phase
-
-        if self.output_enabled:
-            if self.wave == self.SINE:
-                wf = 0.5*self.amplitude*np.sin(argument)
-            elif self.wave == self.TRIANGLE:
-                wf = 0.3183*self.amplitude*np.arcsin(np.cos(argument))
-            elif self.wave == self.SQUARE:
-                wf = 0.3183*self.amplitude*(np.arctan(np.sin(argument))
-                        + np.arctan(1/np.sin(argument)))
-            elif self.wave == self.SAW:
-                argument = 1*np.pi*freq*(self.exttimearray + jitter) + phase
-                wf = -0.3183*self.amplitude*np.arctan(1/np.tan(argument))
-            elif self.wave == self.RSAW:
-                argument = 1*np.pi*freq*(self.exttimearray + jitter) + phase
-                wf = 0.3183*self.amplitude*np.arctan(1/np.tan(argument))
-            elif self.wave == self.PULSE:
-                multiplier_array = np.where(argument % (2*np.pi) < self.dutycycle*2*np.pi, 1, 0)
-                wf = self.amplitude*(multiplier_array - 0.5)
+            freq = self.freq*(1 + self.chirp_var*np.sin(2*np.pi*t/self.chirp_per))
+
+        # Calculate argument, 2*pi*freq*(t + jitter) + phase, directly in the units each wave needs:
+        # periods for the pulse, wavetable entries for the others (the saw tables are built on half the argument,
+        # which has the phase added twice)
+        k = 2*np.pi*freq
+        bias = k*jitter + phase
+        if self.wave == self.PULSE:
+            scale = 1/(2*np.pi)
+        else:
+            scale = self.lut_size/(2*np.pi)
+            if self.wave == self.SAW or self.wave == self.RSAW:
+                bias += phase
+        argument = self.arg_buf
+        np.multiply(self.exttimearray, k*scale, out=argument)
+        argument += bias*scale
+
+        if self.wave == self.PULSE:
+            # High while the phase, as a fraction of the period, is below the duty cycle
+            np.mod(argument, 1.0, out=argument)
+            np.less(argument, self.dutycycle, out=wf)
+            wf -= 0.5
+            wf *= self.amplitude
+        else:
+            # Periodic waves are read from the wavetable at the nearest phase entry
+            np.rint(argument, out=argument)
+            idx = self.idx_buf
+            np.copyto(idx, argument, casting="unsafe")
+            idx &= self.lut_size - 1
+            np.take(self.lut, idx, out=wf)
+            wf *= self.amplitude
             
         # Filter (simulate risetime)
         filt_wl = min(max(int(self.risetime/self.delta), 3), self.totnpoints)
         if not (filt_wl % 2): filt_wl -= 1
-        w = np.blackman(filt_wl)
-        wf = np.convolve(wf, w, 'same')/np.sum(w)
+        # Long windows are cheaper to apply by overlap-add FFT convolution
+        if filt_wl >= self.fft_filter_min:
+            wf = oaconvolve(wf, self.filter_window(filt_wl), 'same')
+        else:
+            wf = np.convolve(wf, self.filter_window(filt_wl), 'same')
         
         # Get only the numper of points wanted
-        wf = wf[self.addpoints:-self.addpoints]
-
-        # Add some noise
-        if self.add_noise:
-            noise = np.random.uniform(-self.noiselevel/2, self.noiselevel/2, size=self.npoints)
-            wf = wf + noise + self.offset
-        else:
-             wf = wf + self.offset
+        return wf[self.addpoints:-self.addpoints]
 
-        self.wf = np.clip(wf, self.min_offset, self.max_offset)
+    # Create full waveform
+    def get_waveform(self):
+        # The shared work and noise buffers are used under the lock, so the sizes also stay consistent between them
+        with self.wf_lock:
+            # With the output off there is nothing to shape or filter, only noise and offset
+            if self.output_enabled:
+                wf = self.shape_waveform()
+            else:
+                wf = np.zeros(self.npoints_ext, dtype=np.float32)
+
+            # Add some noise (wf is a new array every frame, so this is done in place)
+            if self.add_noise:
+                noise = self.noise_buf
+                self.rng.random(dtype=np.float32, out=noise)
+                noise -= 0.5
+                noise *= self.noiselevel
+                wf += noise
+        wf += self.offset
+
+        self.wf = np.clip(wf, self.min_offset, self.max_offset, out=wf)
+        return wf
     
+    # Wavetable for a periodic wave type, built on first use and shared by all instances
+    def wavetable(self, wave):
+        lut = self.luts.get(wave)
+        if lut is None:
+            # Phase as a fraction of the period; all but the sine are piecewise linear in it
+            frac = np.arange(self.lut_size)/self.lut_size
+            if wave == self.SINE:
+                lut = 0.5*np.sin(2*np.pi*frac)
+            elif wave == self.TRIANGLE:
+                lut = 2*np.abs(frac - 0.5) - 0.5
+            elif wave == self.SQUARE:
+                lut = 0.5 - 1.0*(frac >= 0.5)
+            elif wave == self.SAW:
+                lut = frac - 0.5
+            elif wave == self.RSAW:
+                lut = 0.5 - frac
+            else:
+                return None
+            lut = lut.astype(np.float32)
+            lut.setflags(write=False)
+            self.luts[wave] = lut
+        return lut
+
+    # Normalized Blackman window for the risetime filter, cached per length
+    def filter_window(self, filt_wl):
+        w = self.windows.get(filt_wl)
+        if w is None:
+            w = np.blackman(filt_wl)
+            w = (w/w.sum()).astype(np.float32)
+            w.setflags(write=False)
+            self.windows[filt_wl] = w
+        return w
+
     # Recalculate some parameters
     def refresh_params(self):
-        self.min_pulsewidth = self.risetime + self.falltime
-        self.max_pulsewidth = (1/self.freq) - self.min_pulsewidth
-        self.max_dutycycle = self.max_pulsewidth/(1/self.freq)
-        self.min_dutycycle = self.min_pulsewidth/(1/self.freq)
+        with self.wf_lock:
+            self.lut = self.wavetable(self.wave)
+            self.min_pulsewidth = self.risetime + self.falltime
+            self.max_pulsewidth = (1/self.freq) - self.min_pulsewidth
+            self.max_dutycycle = self.max_pulsewidth/(1/self.freq)
+            self.min_dutycycle = self.min_pulsewidth/(1/self.freq)
+
+            # The time arrays only change with the sample time, number of points and time multiplier
+            if (self.sampletime, self.npoints, self.timemult) == self.params_key:
+                return
         
-        self.delta = self.sampletime/self.npoints  # Time step
+            self.delta = self.sampletime/self.npoints  # Time step
         
-        # Points to add (will be cut off later, increases filter precision)
-        self.npoints = int(self.npoints*self.timemult)
-        self.addpoints = int(self.npoints*0.1)
-        self.totnpoints = self.npoints + 2*self.addpoints
+            # Output length with the time multiplier applied (npoints and sampletime stay as set by the inputs)
+            self.npoints_ext = int(self.npoints*self.timemult)
+            self.sampletime_ext = self.sampletime*self.timemult
+
+            # Points to add (will be cut off later, increases filter precision)
+            self.addpoints = int(self.npoints_ext*0.1)
+            self.totnpoints = self.npoints_ext + 2*self.addpoints
+
+            # Added time due to the added points
+            self.addtime = self.delta*self.addpoints
+            self.tottime = self.sampletime_ext + self.addtime
 
-        # Added time due to the added points
-        self.sampletime = self.sampletime*self.timemult
-        self.addtime = self.delta*self.addpoints
-        self.tottime = self.sampletime + self.addtime
+            # Time arrays
+            self.exttimearray = np.linspace(-self.addtime, self.tottime, self.totnpoints)
+            self.timearray = np.linspace(0, self.sampletime_ext, self.npoints_ext)
 
-        # Time arrays
-        self.exttimearray = np.linspace(-self.addtime, self.tottime, self.totnpoints)
-        self.timearray = np.linspace(0, self.sampletime, self.npoints)
+            # Work buffers for the extended waveform
+            self.wf_buf = np.zeros(self.totnpoints, dtype=np.float32)
+            self.arg_buf = np.empty(self.totnpoints)
+            self.idx_buf = np.empty(self.totnpoints, dtype=np.int64)
+            self.noise_buf = np.empty(self.npoints_ext, dtype=np.float32)
+            self.params_key = (self.sampletime, self.npoints, self.timemult)
 
 
     # I/O functions
@@ -549,12 +645,14 @@ class VirtualSignalGenerator(FormUI, WindowUI):
         self.input_sampletime()
         self.input_npoints()
         self.refresh_params()
-        self.wf = np.zeros([self.npoints])
 
         # Get data
-        self.get_waveform()
+        return self.get_waveform()
 
-        return self.wf
+    # Has signal: False only when the output is known to be all zeros, so consumers can skip processing it
+    @property
+    def has_signal(self):
+        return self.output_enabled or self.offset != 0.0 or (self.add_noise and self.noiselevel > 0.0)
 
     # Output time array: outputs the instrument time array on which the signal is based
     def output_timearray(self):
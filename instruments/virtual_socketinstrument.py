@@ -1,7 +1,16 @@
 import socket as sck
 import threading
 import time
+import re
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# One command per line: optional "cat:" prefixes, the command, and optional space separated arguments
+SCPI_RE = re.compile(r"[ \t]*((?:[^:\s]+:)*)([^:\s]+)(?:[ \t]+([^\r\n]*))?")
+
+# Fixed error results, detailed messages are only built when verbose
+ERR_INVALID_SCPI = "Error: Invalid SCPI command received."
+ERR_INVALID_COMMAND = "Error: Command not understood. It is invalid or incomplete."
 
 
 class VirtualSocketInstrument():
@@ -13,12 +22,17 @@ class VirtualSocketInstrument():
         self.running = False
         self.verbose = verbose
         self.s = None
+        self.pool = None
+        self.max_clients = 32
+        self.n_clients = 0
+        self.clients_lock = threading.Lock()
 
         # Commands dictionaries
         self.comms_dicts = {}
         self.comms_misc = {}
         self.comms_scpi = {}
         self.comms_root = {}
+        self.comms_flat = {}
 
         # Misc commands
         self.comms_misc["close"] = self.close
@@ -68,11 +82,32 @@ class VirtualSocketInstrument():
         if self.verbose:
             print(f"Server initialized on host '{self.hostname}'. IP for connection is {self.conn_ip}. Listening on port {self.listen_port}...")
 
+        self.build_comms_flat()
+        self.pool = ThreadPoolExecutor(max_workers=self.max_clients)
         self.running = True
         threading.Thread(target=self.mainLoop).start()
+
+    # Flatten the command dictionaries into a single (categories..., command) -> function table
+    # SCPI and root commands are also reachable without a category
+    def build_comms_flat(self):
+        flat = {}
+        def walk(branch, cats):
+            for name, item in branch.items():
+                if isinstance(item, dict):
+                    walk(item, cats + (name,))
+                else:
+                    flat[cats + (name,)] = item
+        walk(self.comms_dicts, ())
+        for name, func in self.comms_scpi.items():
+            flat[(name,)] = func
+        for name, func in self.comms_root.items():
+            flat[(name,)] = func
+        self.comms_flat = flat
         
     def listen(self):
         conn, addr = self.s.accept()
+        # Replies are written once per packet, so there is nothing to gain from delaying small writes
+        conn.setsockopt(sck.IPPROTO_TCP, sck.TCP_NODELAY, 1)
         if self.verbose:
             print(f"Connection received from {addr}")
         return conn, addr
@@ -82,115 +117,94 @@ class VirtualSocketInstrument():
         data = conn.recv(1024000)
         resp = ""
         ok_comms = False
+        out = bytearray()
         if not data:
             return None
+
+        # Local names for what is used for every command
+        flat = self.comms_flat
+        verbose = self.verbose
+        encode = self.encode_response
         
-        # Parse data
-        raw_comm = data.decode("Latin1").lower()
-        raw_comm = raw_comm.replace("\r", "\n").replace("\n\n", "\n")
-        raw_comms = raw_comm.split("\n")
-        raw_comms = list(filter(None, raw_comms))
-        
-        for full_comm in raw_comms:
-            # Separate categories
-            cat_comm = full_comm.split(":")
-            cats = []
-            if len(cat_comm) > 1:
-                cats = cat_comm[:-1]
-                full_comm = cat_comm[-1]
+        # Parse data, all commands in the packet in a single regex pass
+        for match in SCPI_RE.finditer(data.decode("Latin1").lower()):
+            cats_str, comm_str, args_str = match.groups()
 
-            # Separate arguments
-            comm = full_comm.split(" ")
-            
-            # SCPI commands
-            if (len(cats) < 1) and (comm[0][0] == "*"):
-                if comm[0] in self.comms_scpi:
-                    if self.verbose:
-                        print(f"Valid SCPI command received: {comm}")
-                    if len(comm) > 1:
-                        resp = self.comms_scpi[comm[0]](comm[1:])
-                    else:
-                        resp = self.comms_scpi[comm[0]]([])
-                    if resp:
-                        resp = f"{resp}\n"
-                        if self.verbose:
-                            print(f"Sending response: {resp}"[:100])
-                        conn.sendall(resp.encode("Latin1"))
-                    else:
-                        resp = "1"
-                else:
-                    resp = "Error: Invalid SCPI command received."
-                    if self.verbose:
-                        print(resp)
-            
-            # Root commands
-            elif (len(cats) < 1) and (comm[0] in self.comms_root):
-                if self.verbose:
-                    print(f"Valid command received: {comm}")
-                if len(comm) > 1:
-                    resp = self.comms_root[comm[0]](comm[1:])
-                else:
-                    resp = self.comms_root[comm[0]]([])
+            # Separate categories and arguments, and look the command up in the flat table
+            key = tuple(cats_str.split(":")[:-1]) + (comm_str,) if cats_str else (comm_str,)
+            args = args_str.split() if args_str else []
+            func = flat.get(key)
+
+            # Valid commands
+            if func is not None:
+                if verbose:
+                    print(f"Valid command received: {key} {args}")
+                resp = func(args)
                 if resp:
-                    resp = f"{resp}\n"
-                    if self.verbose:
+                    if verbose:
                         print(f"Sending response: {resp}"[:100])
-                    conn.sendall(resp.encode("Latin1"))
+                    out += encode(resp)
                 else:
                     resp = "1"
-            
-            # Categorized commands
-            elif (len(cats) > 0):
-                branch = self.comms_dicts
-                for i in range(len(cats)):
-                    if cats[i] in branch:
-                        branch = branch[cats[i]]
-                    else:
-                        resp = f"Error: Command {cats} {comm} not understood. It is invalid or incomplete."
-                        if self.verbose:
-                            print(resp)
 
-                if comm[0] in branch:
-                    if self.verbose:
-                        print(f"Valid command received: {comm}")
-                    if len(comm) > 1:
-                        resp = branch[comm[0]](comm[1:])
-                    else:
-                        resp = branch[comm[0]]([])
-                    if resp:
-                        resp = f"{resp}\n"
-                        if self.verbose:
-                            print(f"Sending response: {resp}"[:100])
-                        conn.sendall(resp.encode("Latin1"))
-                    else:
-                        resp = "1"
+            # Invalid SCPI command
+            elif (len(key) == 1) and (comm_str[0] == "*"):
+                resp = ERR_INVALID_SCPI
+                if verbose:
+                    print(resp)
+
             # Invalid command
             else:
-                resp = f"Error: Command {data.decode('Latin1')} not understood. It is invalid or incomplete."
-                if self.verbose:
-                    print(resp)
+                resp = ERR_INVALID_COMMAND
+                if verbose:
+                    print(f"Error: Command {match.group(0).strip()} not understood. It is invalid or incomplete.")
 
             ok_comms = ok_comms or bool(resp)
+
+        # Send all replies to the packet at once
+        if out:
+            conn.sendall(out)
         
         return ok_comms
     
+    # Responses are sent as text with a newline terminator, bytes (binary blocks) are sent as they are
+    def encode_response(self, resp):
+        if isinstance(resp, bytes):
+            return resp + b"\n"
+        return f"{resp}\n".encode("Latin1")
+
     def receiveLoop(self, conn, addr):
-        while self.running:
-            try:
-                resp = self.receive(conn)
-                if (not resp) or (resp is None):
+        try:
+            while self.running:
+                try:
+                    resp = self.receive(conn)
+                    if (not resp) or (resp is None):
+                        break
+                except:
+                    conn.close()
+                    if self.verbose:
+                        print(f"Error communicating with client {addr}. Connection closed.")
                     break
-            except:
-                conn.close()
-                if self.verbose:
-                    print(f"Error communicating with client {addr}. Connection closed.")
-                break
+        finally:
+            with self.clients_lock:
+                self.n_clients -= 1
 
+    # Each client takes one pool worker for as long as it stays connected, so clients over the limit
+    # are closed right away instead of waiting in the pool queue forever
     def mainLoop(self):
         while self.running:
             try:
                 conn, addr = self.listen()
-                threading.Thread(target=self.receiveLoop, args=(conn, addr)).start()
+                with self.clients_lock:
+                    accept = self.n_clients < self.max_clients
+                    if accept:
+                        self.n_clients += 1
+                if not accept:
+                    conn.close()
+                    if self.verbose:
+                        print(f"Too many clients ({self.max_clients}), connection from {addr} refused.")
+                    continue
+                self.pool.submit(self.receiveLoop, conn, addr)
             except:
                 pass
 
@@ -250,6 +264,8 @@ class VirtualSocketInstrument():
         self.running = False
         if self.s:
             self.s.close()
+        if self.pool:
+            self.pool.shutdown(wait=False)
 
     # Root test function
     def test(self, args):
@@ -2,7 +2,7 @@
 # Default voltage unit:
 # By pfjarschel, 2023
 
-import os
+import os, bisect
 import numpy as np
 from instruments.virtual_socketinstrument import VirtualSocketInstrument
 from PyQt6 import uic
@@ -14,12 +14,27 @@ thisfile = os.path.basename(__file__)
 # Load ui file
 FormUI, WindowUI = uic.loadUiType(f"{main_path}/virtual_vsource.ui")
 
+# Voltage ranges (5, 10, 15 and 30 V): span, coarse dial position of 0 V, and lowest voltage
+# A value goes in the first range whose limit (5, 10, 15 V) covers its magnitude, negative values stop at 15 V
+VOLT_LIMITS = [5.0, 10.0, 15.0]
+VOLT_RANGES = [(10.0, 50, -5.0), (20.0, 50, -10.0), (30.0, 50, -15.0), (30.0, 0, 0.0)]
+
+# Output voltage for a range and the coarse (0-100) and fine (-100-100, +-0.5 V) dial positions, clamped to the range
+def compute_vfinal(mode, dial, fine_dial):
+    span, zero, low = VOLT_RANGES[mode]
+    vfinal = (dial/100.0)*span + low + 0.5*fine_dial/100.0
+    return min(max(vfinal, low), low + span)
+
 # Communications class
 class VirtualVSourceComms(VirtualSocketInstrument):
     def __init__(self, dev, verbose=False):
         super().__init__(verbose)
         self.dev = dev
 
+        # Last (voltage, volt? response), only formatted again when the voltage changes
+        # Kept as one tuple so concurrent clients always see a matching pair
+        self.volt_cache = (None, b"")
+
         # Instrument functions
         self.comms_root["volt?"] = self.get_volt
         self.comms_root["volt"] = self.set_volt
@@ -28,37 +43,34 @@ class VirtualVSourceComms(VirtualSocketInstrument):
         return "PFJ Systems Inc., Virtual Voltage Source VVS1, S/N V5437"
     
     def get_volt(self, args):
-        return f"{self.dev.voltage:.3f}"
+        voltage = self.dev.voltage
+        cached_volt, resp = self.volt_cache
+        if voltage != cached_volt:
+            resp = f"{voltage:.3f}".encode("Latin1")
+            self.volt_cache = (voltage, resp)
+        return resp
     
     def set_volt(self, args):
         try:
             if args:
                 val = float(args[0])
-                mult = self.dev.voltDial.value()
-                fine_mult = self.dev.fineDial.value()
-                if (val < -10) or ((val > 10) and (val <= 15)):
-                    self.dev.volt15Radio.setChecked(True)
-                    mult = int(100*(val/30) + 50)
-                    coarse = (mult/100.0)*30.0 - 15.0
-                    fine_mult = int(100*(val - coarse))
-                if ((val < -5) and (val >= -10)) or ((val > 5) and (val <= 10)):
-                    self.dev.volt10Radio.setChecked(True)
-                    mult = int(100*(val/20) + 50)
-                    coarse = (mult/100.0)*20.0 - 10.0
-                    fine_mult = int(100*(val - coarse))
-                if (val >= -5) and (val <= 5):
-                    self.dev.volt5Radio.setChecked(True)
-                    mult = int(100*(val/10) + 50)
-                    coarse = (mult/100.0)*10.0 - 5.0
-                    fine_mult = int(100*(val - coarse))
-                if val > 15:
-                    self.dev.volt30Radio.setChecked(True)
-                    mult = int(100*(val/30))
-                    coarse = (mult/100.0)*30.0
-                    fine_mult = int(100*(val - coarse))
-
+                idx = bisect.bisect_left(VOLT_LIMITS, abs(val))
+                if val < 0:
+                    idx = min(idx, 2)
+                span, zero, low = VOLT_RANGES[idx]
+                self.dev.volt_radios[idx].setChecked(True)
+                mult = int(100*(val/span) + zero)
+                coarse = (mult/100.0)*span + low
+                fine_mult = int(100*(val - coarse))
+
+                # Move both dials without their valueChanged signals, then update the output once
+                self.dev.voltDial.blockSignals(True)
+                self.dev.fineDial.blockSignals(True)
                 self.dev.voltDial.setValue(mult)
                 self.dev.fineDial.setValue(fine_mult)
+                self.dev.voltDial.blockSignals(False)
+                self.dev.fineDial.blockSignals(False)
+                self.dev.setSource()
         except:
             pass
 
@@ -90,6 +102,7 @@ class VirtualVSource(FormUI, WindowUI):
         self.setupOtherUi()
         self.setupActions()
         self.comms = VirtualVSourceComms(self, verbose)
+        self.rng = np.random.default_rng()
 
         self.show()
 
@@ -104,6 +117,9 @@ class VirtualVSource(FormUI, WindowUI):
     def setupOtherUi(self):
         self.lcdNumber.setSmallDecimalPoint(True)
         self.lcdNumber.setDigitCount(5)
+
+        # Range selectors, in the order of VOLT_RANGES
+        self.volt_radios = [self.volt5Radio, self.volt10Radio, self.volt15Radio, self.volt30Radio]
     
     def setupActions(self):
         # Connect UI signals to functions
@@ -117,39 +133,25 @@ class VirtualVSource(FormUI, WindowUI):
     # Internal functions    
     # Create full waveform
     def get_waveform(self):
-        wf = self.voltage*np.ones([self.npoints])
-
-        # Add some noise
+        # A new array every call, since the previous output may still be read by another instrument's thread
+        # With noise, the samples are drawn straight into it and shifted to the voltage, without a separate noise array
         if self.add_noise:
-            noise = np.random.uniform(-self.v_noise/2, self.v_noise/2, size=self.npoints)
-            wf = wf + noise
+            wf = self.rng.random(self.npoints)
+            wf -= 0.5
+            wf *= self.v_noise
+            wf += self.voltage
+        else:
+            wf = np.full(self.npoints, self.voltage)
         
         self.wf = wf
+        return wf
     
     def setSource(self):
-        coarse = 0.0
-        fine = 0.5*self.fineDial.value()/100.0
         vfinal = 0.0
-        if self.volt5Radio.isChecked():
-            coarse = (self.voltDial.value()/100.0)*10.0 - 5.0
-            vfinal = coarse + fine
-            if vfinal > 5: vfinal = 5.0
-            if vfinal < -5: vfinal = -5.0
-        if self.volt10Radio.isChecked():
-            coarse = (self.voltDial.value()/100.0)*20.0 - 10.0
-            vfinal = coarse + fine
-            if vfinal > 10: vfinal = 10.0
-            if vfinal < -10: vfinal = -10.0
-        if self.volt15Radio.isChecked():
-            coarse = (self.voltDial.value()/100.0)*30.0 - 15.0
-            vfinal = coarse + fine
-            if vfinal > 15: vfinal = 15.0
-            if vfinal < -15: vfinal = -15.0
-        if self.volt30Radio.isChecked():
-            coarse = (self.voltDial.value()/100.0)*30.0
-            vfinal = coarse + fine
-            if vfinal > 30: vfinal = 30.0
-            if vfinal < 0: vfinal = 0.0
+        for mode, radio in enumerate(self.volt_radios):
+            if radio.isChecked():
+                vfinal = compute_vfinal(mode, self.voltDial.value(), self.fineDial.value())
+                break
         
         self.voltage = vfinal
         self.lcdNumber.display(f"{vfinal:.2f}")
@@ -178,8 +180,11 @@ class VirtualVSource(FormUI, WindowUI):
     def output_signal(self):
         # Get npoints
         self.input_npoints()
-        self.wf = np.zeros([self.npoints])
 
         # Get data
-        self.get_waveform()
-        return self.wf
\ No newline at end of file
+        return self.get_waveform()
+
+    # Has signal: False only when the output is known to be all zeros, so consumers can skip processing it
+    @property
+    def has_signal(self):
+        return self.voltage != 0.0 or (self.add_noise and self.v_noise > 0.0)
\ No newline at end of file
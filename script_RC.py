@@ -1,6 +1,6 @@
 import pyvisa as visa
 import numpy as np
-import time
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 
 # Standard visa stuff. Instruments will "probably" not appear on rm.list_resources()
@@ -15,6 +15,20 @@ osc = rm.open_resource(osc_str)
 osc.read_termination = "\n"
 print(osc.query("*IDN?"))
 
+# Waveforms are transferred as binary blocks of little-endian float32 (IEEE 488.2 "#<n><length><data>")
+osc.write("acq:format binary")
+osc.chunk_size = 1 << 20
+def query_trace(cmd):
+    return osc.query_binary_values(cmd, datatype="f", is_big_endian=False, container=np.array)
+
+# Wait for an instrument to process all the commands sent so far, instead of sleeping a fixed time
+def sync(dev):
+    dev.query("*OPC?")
+
+# Wait until the oscilloscope has acquired a frame with the current settings
+def settle():
+    osc.query("settle?")
+
 sg = rm.open_resource(sg_str)
 sg.read_termination = "\n"
 print(sg.query("*IDN?"))
@@ -41,51 +55,29 @@ print(f"Exact cutoff freq.: {fc:.3f} Hz")
 # Set signal generator properties
 freq0 = 700.0
 sg.write(f"freq:freq {freq0}")
-time.sleep(0.1)
 sg.write("amp:amp 10.0")
-time.sleep(0.1)
 sg.write("out 1")
-time.sleep(0.1)
 sg.write("amp:offs 0.0")
-time.sleep(0.1)
 sg.write("wave:wave sine")
-time.sleep(0.1)
 sg.write("wave:dc 0")
-time.sleep(0.1)
 sg.write("wave:phas 0.0")
+sync(sg)
 
 
 # Adjust oscilloscope and start getting data
 osc.write("run")  # This causes error, use graphical interface for now
 osc.write("trig:auto")
-time.sleep(0.1)
 osc.write("horiz:scale 0.0005")
-time.sleep(0.1)
 osc.write("c1:scale 2")
-time.sleep(0.1)
 osc.write("c2:enable on")
-time.sleep(0.1)
 osc.write("c2:scale 2")
-time.sleep(1.0)
+settle()
 
 
 # Get data
-data_x_str = osc.query("horiz:data?")
-data_c1_str = osc.query("c1:data?")
-data_c2_str = osc.query("c2:data?")
-
-data_x_split = data_x_str.split(",")
-data_c1_split = data_c1_str.split(",")
-data_c2_split = data_c2_str.split(",")
-
-data_x = []
-data_c1 = []
-data_c2 = []
-
-for i in range(len(data_x_split)):
-    data_x.append(float(data_x_split[i]))
-    data_c1.append(float(data_c1_split[i]))
-    data_c2.append(float(data_c2_split[i]))
+data_x = query_trace("horiz:data?")
+data_c1 = query_trace("c1:data?")
+data_c2 = query_trace("c2:data?")
 
 # Plot captured data. Script will pause here, until plot window is closed
 plt.plot(data_x, data_c1)
@@ -100,34 +92,39 @@ freqs = np.logspace(1, 4, 100)  # 10 Hz to 10 KHz
 
 # Go to initial condition (not always necessary, but can help)
 sg.write(f"freq:freq {freqs[0]}")
-time.sleep(0.1)
 osc.write(f"horiz:scale {0.05}")
-time.sleep(0.5)
+sync(sg)
+settle()
 
-amps = []
+amps = np.empty_like(freqs)
 n_periods = 4  # Periods to be displayed
 n_divs = 10  # Fixed, usually 8 or 10 in real oscs
-for freq in freqs:
-    sg.write(f"freq:freq {freq}")
-    time.sleep(0.1)
-    
-    period = 1/freq
-    total_time = period*n_periods
-    osc_scale = total_time/n_divs
-    
-    osc.write(f"horiz:scale {osc_scale}")
-    time.sleep(0.5)  # Wait a little more to get data
-    
-    data_c2_str = osc.query("c2:data?")
-    data_c2_split = data_c2_str.split(",")
-    data_c2 = []
-    for i in range(len(data_x_split)):
-        data_c2.append(float(data_c2_split[i]))
-    amps.append(np.ptp(data_c2[int(len(data_c2)/2):]))  # Only last half to avoid deformation at start
+osc_scales = n_periods/(freqs*n_divs)  # Period*n_periods over the divisions
+
+# Program both instruments back to back for a sweep step
+def program(k):
+    sg.write(f"freq:freq {freqs[k]}")
+    osc.write(f"horiz:scale {osc_scales[k]}")
+
+# The next step is programmed in the background while the current trace is processed
+with ThreadPoolExecutor(max_workers=1) as pool:
+    pending = pool.submit(program, 0)
+    for k in range(len(freqs)):
+        # The generator must be done before settle? starts counting frames
+        pending.result()
+        sync(sg)
+        settle()  # Wait for a frame with the new settings
+
+        data_c2 = query_trace("c2:data?")
+        if k + 1 < len(freqs):
+            pending = pool.submit(program, k + 1)
+
+        half = data_c2.size//2
+        amps[k] = np.ptp(data_c2[half:])  # Only last half to avoid deformation at start
 
 # DB scale, max is 0
-dbv = 20*np.log10(np.array(amps))
-dbv = dbv - dbv.max()
+dbv = 20*np.log10(amps)
+dbv -= dbv.max()
 
 plt.semilogx(freqs, dbv)
 plt.xlabel("Frequency (Hz)")
@@ -135,18 +132,17 @@ plt.ylabel("Peak-Peak (dB)")
 plt.show()
 
 # Calculate cut-off frequency finding the closest measurement point
-cutoff_idx = np.abs(dbv - (-3)).argmin()  # Closest to -3
+# The RC response falls monotonically with frequency, so -dbv is sorted and the -3 dB crossing can be bisected
+cutoff_idx = int(np.clip(np.searchsorted(-dbv, 3.0), 1, len(dbv) - 1))
+if abs(dbv[cutoff_idx - 1] + 3) < abs(dbv[cutoff_idx] + 3):
+    cutoff_idx -= 1  # Closest to -3
 cutoff_freq = freqs[cutoff_idx]
 print(f"Experimental cutoff freq.: {cutoff_freq:.3f} Hz")
 
-# Calculate cut-off frequency by interpolating around previous value
-if dbv[cutoff_idx] < -3:
-    dbv_vals = [dbv[cutoff_idx - 1], dbv[cutoff_idx]]
-    freq_vals = [freqs[cutoff_idx - 1], freqs[cutoff_idx]]
-else:
-    dbv_vals = [dbv[cutoff_idx], dbv[cutoff_idx + 1]]
-    freq_vals = [freqs[cutoff_idx], freqs[cutoff_idx + 1]]
-cutoff_freq_interp = freq_vals[0] + (-3 - dbv_vals[0])/((dbv_vals[1] - dbv_vals[0])/(freq_vals[1] - freq_vals[0]))
+# Calculate cut-off frequency by interpolating the -3 dB point on the log frequency axis (np.interp needs increasing x)
+order = np.argsort(dbv)
+f_log = np.log10(freqs)
+cutoff_freq_interp = 10**np.interp(-3.0, dbv[order], f_log[order])
 
 # Calculate time constant
 calc_rc = 1/(2*np.pi*cutoff_freq)
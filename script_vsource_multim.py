@@ -27,10 +27,14 @@ pts = 10
 times = np.zeros(pts)
 volts = np.zeros(pts)
 
+# Draw all the setpoints at once, before the measurement loop
+rng = np.random.default_rng()
+vals = rng.integers(-1000, 1000, size=pts)/100.0
+
 t0 = time.time()
 for i in range(pts):
     times[i] = time.time() - t0
-    vs.write(f"volt {np.random.randint(-1000,1000)/100.0}")
+    vs.write(f"volt {vals[i]:.2f}")
     volts[i] = mult.query("meas:volt?")
     time.sleep(1.1)
 